@@ -458,6 +458,7 @@ def vertexes(pos):
 def switch():
     if state.game_frame.window.hide:
         state.game_frame.window.map.lit()
+        state.game_frame.window.seen = None
         state.game_frame.window.hide = False
     else:
         state.game_frame.window.hide = True
@@ -492,8 +493,7 @@ def open_(pos):
     door = state.game_frame.window.map[pos]
     if door.wall == True:
         state.output("Lock opened")
-        door.wall = False
-        door.obscure = False
+        state.game_frame.window.map.set_state(pos, False)
     else:
         state.output("Lock is already open")
     state.game_frame.window.has_moved = True
@@ -502,8 +502,7 @@ def close(pos):
     door = state.game_frame.window.map[pos]
     if door.wall == False:
         state.output("Lock closed")
-        door.wall = True
-        door.obscure = True
+        state.game_frame.window.map.set_state(pos, True)
     else:
         state.output("Lock is already closed")
     state.game_frame.window.has_moved = True
@@ -518,9 +517,24 @@ def load(map_name):
         map_name += ".mp"
     file = os.path.join(state.BASEDIR, "maps", map_name)
     state.game_frame.window.map.load_file(file)
+    state.game_frame.levels.start(state.game_frame.window.map)
     state.game_frame.window.draw()
     state.output("Map loaded!")
 
+def toggle_metrics():
+    window = state.game_frame.window.metrics_window
+    if window in state.screen.windows:
+        state.screen.remove_window(window)
+    else:
+        state.screen.add_window(window)
+
+def export_metrics(name):
+    if not name.endswith(".json"):
+        name += ".json"
+    file = os.path.join(state.BASEDIR, name)
+    state.metrics.export(file)
+    state.output("Metrics exported into %s" % file)
+
 def autotrigger():
     state.action_frame.autotrigger ^= True
     state.output("Changed command trigger mode")
@@ -547,6 +561,8 @@ C-x -> *exit current command*
 next -> *scroll down messages*
 prior -> *scoll up messages*
 u -> switch autotrigger
+> -> descend
+< -> ascend
 [c] -> create <entity> <pos>
 [d] -> delete <pos>
 [z] -> vertexes <pos>
@@ -556,11 +572,13 @@ u -> switch autotrigger
 [C] -> compare <shadow1> <shadow2>
 [j] -> join <shadow1> <shadow2>
 [C-l] -> load
-[N] -> neighboors <pos>"""
+[N] -> neighboors <pos>
+[m] -> metrics
+[M] -> export metrics <name>"""
     )
     
 def init_actions():
-    global look_action, quit_action, idle_action, attack_action, left_action, up_action, right_action, down_action, left_action, move_mode_action, save_action, create_action, delete_action, delete_action, vertexes_action, coords_action, switch_action, shadow_action, compare_action, name_action, join_action, open_action, close_action, pickup_action, load_action, help_action, switch_trigger_action, neighboors_action
+    global look_action, quit_action, idle_action, attack_action, left_action, up_action, right_action, down_action, left_action, move_mode_action, save_action, create_action, delete_action, delete_action, vertexes_action, coords_action, switch_action, shadow_action, compare_action, name_action, join_action, open_action, close_action, pickup_action, load_action, help_action, switch_trigger_action, neighboors_action, descend_action, ascend_action, metrics_action, export_metrics_action
     look_action = Action(
         "look",
         [Argument("pos", PromptPos())],
@@ -713,3 +731,23 @@ def init_actions():
         [Argument("pos", PromptPos())],
         neighboors
     )
+    descend_action = Action(
+        "descend",
+        [],
+        lambda: state.game_frame.change_level(1)
+    )
+    ascend_action = Action(
+        "ascend",
+        [],
+        lambda: state.game_frame.change_level(-1)
+    )
+    metrics_action = Action(
+        "metrics",
+        [],
+        toggle_metrics
+    )
+    export_metrics_action = Action(
+        "export metrics",
+        [Argument("name", AskString())],
+        export_metrics
+    )
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+### Assets module
+# Parsing of the definition files (tiles/*.tl, creatures/*.crt): a file is
+# a list of `key value;;' entries, every value being a Python literal.
+# Parsed files are cached by modification time and size, so that unchanged
+# directories are loaded without being parsed again.
+#
+# Every asset (icons, items, tiles, families, creatures) can also be packed
+# into a single bundle, used as long as the sources are the ones it was
+# built from (same files, modification times and sizes).
+# Build it with: python3 assets.py
+
+import ast, configparser, os, pickle
+from collections import namedtuple
+import state
+
+CACHE_DIR = state.realpath(".assetcache")
+CACHE_VERSION = 1
+BUNDLE_FILE = state.realpath("assets.bundle")
+BUNDLE_VERSION = 2
+# directory and extension of each kind of asset
+SOURCES = {
+    "icons": ("icons", ".ico"),
+    "items": ("items", ".it"),
+    "tiles": ("tiles", ".tl"),
+    "families": ("tiles", ".fmly"),
+    "creatures": ("creatures", ".crt")
+}
+
+class DefinitionError(Exception):
+    pass
+
+TileDef = namedtuple("TileDef", ["char", "repr", "wall", "obscure", "desc", "openable", "replace_family", "family"])
+CreatureDef = namedtuple("CreatureDef", ["name", "ai", "creature_id", "attributes", "triggers"])
+
+TILE_DEFAULTS = {
+    "wall": True,
+    "obscure": False,
+    "desc": "tile",
+    "openable": False,
+    "replace-family": False,
+    "family": None
+}
+TILE_KEYS = {"char", "repr", "wall", "obscure", "desc", "openable", "replace-family", "family"}
+
+def parse_entries(text, file):
+    # returns [(key, value)]
+    entries = []
+    for entry in text.split(";;"):
+        entry = entry.strip()
+        if not entry:
+            continue
+        key, *value = entry.split(None, 1)
+        if not value:
+            raise DefinitionError("%s: entry %s has no value" % (file, key))
+        try:
+            entries.append((key, ast.literal_eval(value[0].strip())))
+        except (ValueError, SyntaxError):
+            raise DefinitionError("%s: %s isn't a literal (entry %s)" % (file, value[0], key))
+    return entries
+
+def parse_tile(text, file):
+    result = TILE_DEFAULTS.copy()
+    for key, value in parse_entries(text, file):
+        if key in TILE_KEYS:
+            result[key] = value
+        else:
+            state.warning("Tile %s contains an wrong entry: %s" % (file[:-3], key))
+    if "char" not in result:
+        state.warning("Tile %s doesn't contain a `char' entry, this shouldn't happend." % file[:-3])
+        result["char"] = '\x00'
+    return TileDef(result["char"], result.get("repr", result["char"]), result["wall"], result["obscure"], result["desc"], result["openable"], result["replace-family"], result["family"])
+
+def parse_creature(text, file):
+    attributes = dict(parse_entries(text, file))
+    for key in ("ai", "creature_id"):
+        if key not in attributes:
+            raise DefinitionError("%s: missing entry %s" % (file, key))
+    triggers = {key[3:]: attributes.pop(key) for key in list(attributes) if key.startswith("on_")}
+    return CreatureDef(file[:-4], attributes.pop("ai"), attributes["creature_id"], attributes, triggers)
+
+def read_cache(cache_file):
+    try:
+        with open(cache_file, "rb") as f:
+            version, cache = pickle.load(f)
+    except (OSError, EOFError, pickle.PickleError, ValueError, TypeError, AttributeError):
+        return {}
+    return cache if version == CACHE_VERSION else {}
+
+def write_cache(cache_file, cache):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_file + ".tmp", "wb") as f:
+            pickle.dump((CACHE_VERSION, cache), f)
+        os.replace(cache_file + ".tmp", cache_file)
+    except OSError:
+        # a read-only install works, only slower
+        pass
+
+def load_directory(directory, extension, parse):
+    # {file name: record} for every file of `directory' ending with `extension'
+    cache_file = os.path.join(CACHE_DIR, os.path.basename(directory) + ".cache")
+    cache = read_cache(cache_file)
+    new_cache = {}
+    records = {}
+    pwd, _, files = next(os.walk(directory))
+    for file in sorted(files):
+        if not file.endswith(extension):
+            continue
+        path = os.path.join(pwd, file)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if file in cache and cache[file][0] == key:
+            record = cache[file][1]
+        else:
+            with open(path) as f:
+                record = parse(f.read(), file)
+        new_cache[file] = (key, record)
+        records[file] = record
+    if new_cache != cache:
+        write_cache(cache_file, new_cache)
+    return records
+
+def read_files(kind):
+    # {name: content} of the files of a kind of asset
+    directory, extension = SOURCES[kind]
+    pwd, _, files = next(os.walk(state.realpath(directory)))
+    contents = {}
+    for file in files:
+        if not file.endswith(extension):
+            continue
+        with open(os.path.join(pwd, file)) as f:
+            contents[file[:-len(extension)]] = f.read()
+    return contents
+
+def read_items():
+    # {name: {section: {key: value}}}
+    directory, extension = SOURCES["items"]
+    pwd, _, files = next(os.walk(state.realpath(directory)))
+    items = {}
+    for file in files:
+        if not file.endswith(extension):
+            continue
+        item = configparser.ConfigParser()
+        item.read(os.path.join(pwd, file))
+        items[file[:-len(extension)]] = {section: dict(item[section]) for section in item.sections()}
+    return items
+
+def read_tiles():
+    # {char: TileDef}
+    return {tile.char: tile for tile in load_directory(state.realpath("tiles"), ".tl", parse_tile).values()}
+
+def read_creatures():
+    # {name: CreatureDef}
+    return {crt.name: crt for crt in load_directory(state.realpath("creatures"), ".crt", parse_creature).values()}
+
+READERS = {
+    "icons": lambda: read_files("icons"),
+    "items": read_items,
+    "tiles": read_tiles,
+    "families": lambda: read_files("families"),
+    "creatures": read_creatures
+}
+
+def sources_key():
+    # (directory, file, modification time, size) of every source, so that a
+    # source added, removed or renamed is noticed as well as a changed one
+    key = set()
+    for directory, extension in SOURCES.values():
+        pwd, _, files = next(os.walk(state.realpath(directory)))
+        for file in files:
+            if file.endswith(extension):
+                stat = os.stat(os.path.join(pwd, file))
+                key.add((directory, file, stat.st_mtime_ns, stat.st_size))
+    return sorted(key)
+
+def build_bundle():
+    # the key of the sources first, so that a stale bundle isn't read further
+    key = sources_key()
+    assets = {kind: reader() for kind, reader in READERS.items()}
+    with open(BUNDLE_FILE + ".tmp", "wb") as f:
+        pickle.dump((BUNDLE_VERSION, key), f)
+        pickle.dump(assets, f)
+    os.replace(BUNDLE_FILE + ".tmp", BUNDLE_FILE)
+
+# bundle in use, checked once
+bundle = None
+bundle_checked = False
+
+def get_bundle():
+    global bundle, bundle_checked
+    if not bundle_checked:
+        bundle_checked = True
+        try:
+            with open(BUNDLE_FILE, "rb") as f:
+                version, key = pickle.load(f)
+                if version == BUNDLE_VERSION and key == sources_key():
+                    bundle = pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError, ValueError, TypeError, AttributeError):
+            bundle = None
+    return bundle
+
+def load(kind):
+    # assets of a kind, from the bundle if it can be used
+    assets = get_bundle()
+    if assets is not None:
+        return assets[kind]
+    return READERS[kind]()
+
+def load_tiles():
+    return load("tiles")
+
+def load_creatures():
+    return load("creatures")
+
+if __name__ == "__main__":
+    # through the module, so that the records are pickled as assets.*
+    import assets
+    assets.build_bundle()
+    print("assets bundled into %s" % BUNDLE_FILE)
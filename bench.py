@@ -0,0 +1,868 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+### Benchmarks
+# Runs without a terminal: python3 bench.py [name...]
+# (every benchmark is run when no name is given)
+
+import sys, os, time, random, queue, shutil, subprocess, tempfile, tracemalloc, pty, signal, select, fcntl, termios, struct
+
+import state, grid, mapfile, assets, savefile, io, json
+
+class NullMessages:
+    # stands for the message window, keeps the messages
+    def __init__(self):
+        self.messages = []
+    def update_messages(self, message):
+        self.messages.append(message)
+
+class NullScreen:
+    size = (50, 150)
+
+def headless(height=50, width=150):
+    # sets up the frames of the game without any screen
+    state.message_window = NullMessages()
+    state.load()
+    game_window = state.GameWindow(NullScreen(), 0, 0, height, width)
+    state.game_frame = state.GameFrame(game_window)
+    return game_window
+
+def timeit(function, repeat=3):
+    best = float("inf")
+    for i in range(repeat):
+        t = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter()-t)
+    return best
+
+def measure_memory(function):
+    tracemalloc.start()
+    result = function()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+def report(name, value, unit):
+    print("  %-40s %12.3f %s" % (name, value, unit))
+
+class LegacyTile:
+    # a cell as it used to be stored, every attribute copied in each tile
+    def __init__(self, rchar, char, wall, obscure, desc, openable=False, replace_fam=None, family=None):
+        self.rchar = rchar
+        self.char = char
+        self.wall = wall
+        self.desc = desc
+        self.openable = openable
+        self.replace_fam = replace_fam
+        self.family = family
+        self.obscure = obscure
+        self.lit = 2
+        self.creatures = []
+        self.items = []
+        self.highlight = False
+        self.known = False
+
+class LegacyWalkGen:
+    # the cells by chebyshev distance, as the shadows walk used to find them
+    def __init__(self, start):
+        self.start = start
+        self.visited = {start}
+        self.border = queue.PriorityQueue()
+        self.border.put_nowait((0,start))
+    def __next__(self):
+        distance, current = self.border.get_nowait()
+        for dir in {state.UP, state.RIGHT, state.DOWN, state.LEFT}:
+            next = state.add_tuples(dir, current)
+            if next not in self.visited:
+                self.visited.add(next)
+                self.border.put_nowait((state.diag_distance(next, self.start),next))
+        return current
+
+def legacy_a_star(m, start, end):
+    # the search as it used to be, its heuristic being always 0
+    border = queue.PriorityQueue()
+    border.put_nowait((0, start))
+    came_from = {start: None}
+    cost_so_far = {start: 0}
+    while border.qsize() > 0:
+        distance, current = border.get_nowait()
+        if current == end:
+            break
+        for dir in {state.UP, state.RIGHT, state.DOWN, state.LEFT}:
+            next = state.add_tuples(current, dir)
+            if not m[next] or m[next].wall:
+                continue
+            new_cost = cost_so_far[current] + 1
+            if next not in cost_so_far or new_cost < cost_so_far[next]:
+                cost_so_far[next] = new_cost
+                came_from[next] = current
+                border.put_nowait((new_cost, next))
+    path = []
+    current = end
+    while current != start:
+        # KeyError when end wasn't reached
+        path.append(current)
+        current = came_from[current]
+    path.reverse()
+    return tuple(path)
+
+def corridor_tiles(rows, length):
+    # a corridor winding over `rows' rows of `length' cells, each row
+    # joined to the next at one end, and a door at the middle of each wall
+    # between two rows, closed; returns the tiles and the doors
+    tiles = {}
+    doors = []
+    for y in range(2*rows+1):
+        for x in range(length+2):
+            tiles[y,x] = state.map.Tile(state.map.WALL_TILE)
+    for row in range(rows):
+        for x in range(1, length+1):
+            tiles[2*row+1, x] = state.map.Tile(state.map.GROUND_TILE)
+        if row < rows-1:
+            tiles[2*row+2, length if row % 2 == 0 else 1] = state.map.Tile(state.map.GROUND_TILE)
+            doors.append((2*row+2, length//2))
+    for pos in doors:
+        tiles[pos] = state.map.Tile(state.map.DOOR_TILE)
+    return tiles, doors
+
+def big_tiles(height, width, tile=LegacyTile):
+    # dict version of a map: rooms of 10x10 separated by walls
+    tiles = {}
+    for y in range(height):
+        for x in range(width):
+            if y % 10 == 0 or x % 10 == 0:
+                tiles[y,x] = tile("#", "#", True, True, "wall")
+            else:
+                tiles[y,x] = tile(".", "·", False, False, "inside ground")
+    return tiles
+
+def write_big_map(file, size):
+    # tiles maps/map2.mp over a size*size map
+    with open(state.realpath("maps", "map2.mp")) as f:
+        objs, *lines = f.read().split("\n")
+    width = max(len(line) for line in lines)
+    lines = [line.ljust(width) for line in lines]
+    with open(file, "w") as f:
+        f.write(objs + "\n")
+        f.write("\n".join((lines[y % len(lines)] * (size//width+1))[:size] for y in range(size)))
+
+def bench_grid(size=500, lookups=200000):
+    print("grid: %sx%s map, %s lookups" % (size, size, lookups))
+    tiles, dict_memory = measure_memory(lambda: big_tiles(size, size))
+    # the same rooms as flyweight tiles, which is what the grid takes
+    cells = {pos: state.map.Tile(state.map.WALL_TILE if tile.wall else state.map.GROUND_TILE) for pos, tile in tiles.items()}
+    def build():
+        m = state.map.Map()
+        m.set_tiles(cells)
+        return m
+    m, grid_memory = measure_memory(build)
+    report("dict memory", dict_memory/2**20, "MiB")
+    report("chunked grid memory", grid_memory/2**20, "MiB")
+    rng = random.Random(0)
+    positions = [(rng.randint(-10, size+10), rng.randint(-10, size+10)) for i in range(lookups)]
+    def dict_lookup():
+        for pos in positions:
+            tile = tiles[pos] if pos in tiles else state.map.NoTile()
+            tile.wall
+    def grid_lookup():
+        for pos in positions:
+            m[pos].wall
+    def flags_lookup():
+        for pos in positions:
+            m.walkable(pos)
+    # map[pos] makes a TileView, which costs more than the tile the dict
+    # kept; the hot paths (is_walkable, draw_map, the bitmaps of the FOV and
+    # pathfinding) read the flags instead
+    report("dict lookup", timeit(dict_lookup)*10**9/lookups, "ns/lookup")
+    report("chunked grid lookup, TileView", timeit(grid_lookup)*10**9/lookups, "ns/lookup")
+    report("chunked grid lookup, flags", timeit(flags_lookup)*10**9/lookups, "ns/lookup")
+
+def bench_tiles(count=100000, size=600):
+    print("tiles: %s tiles, loading a %sx%s map" % (count, size, size))
+    def legacy():
+        return [LegacyTile(".", "·", False, False, "inside ground") for i in range(count)]
+    def flyweight():
+        ground = state.map.TileType(".", "·", False, False, "inside ground")
+        return [state.map.Tile(ground) for i in range(count)]
+    report("legacy tile", measure_memory(legacy)[1]/count, "B/tile")
+    report("flyweight tile", measure_memory(flyweight)[1]/count, "B/tile")
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, "big.mp")
+        write_big_map(file, size)
+        m = state.game_frame.window.map
+        m.file = file
+        report("Map.load", timeit(m.load, repeat=1), "s")
+
+def bench_mapfile(size=2000, lookups=10000):
+    print("mapfile: %sx%s map" % (size, size))
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, "big.mp")
+        write_big_map(file, size)
+        m = state.map.Map()
+        m.load_families()
+        m.load_tiles()
+        report("parse .mp", timeit(lambda: m.read(file), repeat=1), "s")
+        compiled = mapfile.compiled_name(file)
+        report("write .mpc", timeit(lambda: mapfile.write_grid(compiled, m.grid, {"creatures": [], "items": []}), repeat=1), "s")
+        report("open .mpc", timeit(lambda: mapfile.open_map(compiled))*1000, "ms")
+        rng = random.Random(0)
+        positions = [(rng.randrange(size), rng.randrange(size)) for i in range(lookups)]
+        def first_lookups():
+            m.grid = mapfile.open_map(compiled)
+            for pos in positions:
+                m[pos].wall
+        report("open .mpc + %s random lookups" % lookups, timeit(first_lookups)*1000, "ms")
+        def first_bitmaps():
+            m.grid = mapfile.open_map(compiled)
+            grid.Bitmaps(m.grid)
+        report("open .mpc + bitmaps", timeit(first_bitmaps, repeat=1)*1000, "ms")
+        # the bitmaps are read from the flag layer, no chunk is loaded
+        assert not m.grid.tried, "%s chunks loaded by the bitmaps" % len(m.grid.tried)
+
+def bench_assets():
+    print("assets: tiles and creatures definitions")
+    # a cache of its own, the one of the game being left alone
+    with tempfile.TemporaryDirectory() as directory:
+        cache_dir = assets.CACHE_DIR
+        assets.CACHE_DIR = directory
+        def cold():
+            for file in os.listdir(directory):
+                os.remove(os.path.join(directory, file))
+            assets.read_tiles()
+            assets.read_creatures()
+        def warm():
+            assets.read_tiles()
+            assets.read_creatures()
+        try:
+            report("parse (no cache)", timeit(cold)*1000, "ms")
+            report("cached", timeit(warm)*1000, "ms")
+        finally:
+            assets.CACHE_DIR = cache_dir
+
+# the cache and the bundle are set to the ones of the benchmark first
+STARTUP = "import curses.ascii, state, assets; assets.CACHE_DIR, assets.BUNDLE_FILE = %r, %r; "
+LOAD = "state.load(); m = state.map.Map(); m.load_tiles(); m.load_families()"
+BUNDLE = "assets.build_bundle()"
+
+def bench_startup(runs=10):
+    print("startup: loading every asset in a new process, %s runs" % runs)
+    with tempfile.TemporaryDirectory() as directory:
+        cache_dir = os.path.join(directory, "cache")
+        bundle_file = os.path.join(directory, "assets.bundle")
+        def run(code=LOAD):
+            subprocess.run([sys.executable, "-c", STARTUP % (cache_dir, bundle_file) + code], cwd=state.BASEDIR, check=True)
+        def cold():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            run()
+        report("directories, no cache", timeit(cold, repeat=runs)*1000, "ms")
+        report("directories, cached definitions", timeit(run, repeat=runs)*1000, "ms")
+        run(BUNDLE)
+        report("bundle", timeit(run, repeat=runs)*1000, "ms")
+
+def bench_autotile(size=500, changes=1000):
+    print("autotile: %sx%s map, %s changed cells" % (size, size, changes))
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, "big.mp")
+        write_big_map(file, size)
+        m = state.map.Map()
+        m.load_families()
+        m.load_tiles()
+        report("parse .mp with family replacement", timeit(lambda: m.read(file), repeat=1), "s")
+        rng = random.Random(0)
+        walls = [pos for pos in m.grid.positions() if m[pos].type.replace_fam]
+        positions = [rng.choice(walls) for i in range(changes)]
+        report("retile around a cell", timeit(lambda: [m.retile(pos) for pos in positions])*10**6/changes, "us/cell")
+
+def bench_levels(changes=10):
+    print("levels: going down %s levels" % changes)
+    frame = state.game_frame
+    state.action.init_actions()
+    frame.load_map()
+    manager = frame.levels
+    report("generate a level", timeit(manager.generate)*1000, "ms")
+    def descend():
+        # the next level has had the time to be generated
+        manager.generating[manager.depth+1].result()
+        frame.change_level(1)
+    report("change level, pre-generated", timeit(descend, repeat=changes)*1000, "ms")
+    def ascend():
+        # back to the surface, through evicted levels
+        for i in range(changes):
+            frame.change_level(-1)
+    report("change level, going back up", timeit(ascend, repeat=1)*1000/changes, "ms")
+    manager.close()
+
+def bench_spatial(count=10000, size=1000, queries=1000):
+    print("spatial: %s creatures over %sx%s cells, %s queries" % (count, size, size, queries))
+    rng = random.Random(0)
+    positions = {uuid: (rng.randrange(size), rng.randrange(size)) for uuid in range(count)}
+    index = state.spatial.SpatialIndex()
+    report("build index", timeit(lambda: [index.add(uuid, pos) for uuid, pos in positions.items()])*1000, "ms")
+    centers = [(rng.randrange(size), rng.randrange(size)) for i in range(queries)]
+    def scan():
+        for center in centers:
+            [uuid for uuid, pos in positions.items() if state.distance(pos, center) <= 5]
+    def radius():
+        for center in centers:
+            list(index.radius(center, 5))
+    def nearest():
+        for center in centers:
+            index.nearest(center, 5)
+    report("radius 5, full scan", timeit(scan, repeat=1)*10**6/queries, "us/query")
+    report("radius 5, index", timeit(radius)*10**6/queries, "us/query")
+    report("5 nearest, index", timeit(nearest)*10**6/queries, "us/query")
+
+def bench_components(count=5000, size=200):
+    print("components: %s creatures over %sx%s cells" % (count, size, size))
+    rng = random.Random(0)
+    def spawn():
+        return [state.creature.Creature(pos=(rng.randrange(size), rng.randrange(size)), life=10**6, max_life=10**6) for i in range(count)]
+    creatures = spawn()
+    store = state.components.ComponentStore()
+    for creature in spawn():
+        store.bind(creature)
+    center, radius = (size//2, size//2), size//4
+    def objects_damage():
+        for creature in creatures:
+            if state.distance(creature.pos, center) <= radius:
+                creature.life -= creature.compute_realdamage(10)
+    def objects_regenerate():
+        for creature in creatures:
+            creature.life = min(creature.life + 1, creature.max_life)
+    report("area damage, objects", timeit(objects_damage)*1000, "ms")
+    report("regeneration, objects", timeit(objects_regenerate)*1000, "ms")
+    numpy = state.components.load_numpy()
+    for name in ("numpy", "arrays") if numpy != None else ("arrays",):
+        state.components.numpy = numpy if name == "numpy" else False
+        report("area damage, store, %s" % name, timeit(lambda: store.damage(store.in_radius(center, radius), 10))*1000, "ms")
+        report("regeneration, store, %s" % name, timeit(lambda: store.regenerate(1))*1000, "ms")
+    state.components.numpy = numpy or False
+
+def fov_window(m, radius):
+    # a game window over `m' large enough for the walk to reach `radius'
+    window = state.GameWindow(NullScreen(), 0, 0, 2*radius+4, 2*radius+4)
+    window.map = m
+    return window
+
+def check_fov(m, positions, max_range=20):
+    # differential test of the shadowcasting against the walk, where both
+    # apply: the walk stops at the first ring holding a cell out of range,
+    # about max_range/sqrt(2); returns the counts of the cells lit by one
+    # engine only. Asserts that the shadowcasting
+    #  - lights every cell with a clear line of sight (fov.sees),
+    #  - is symmetric: b lit from a if and only if a lit from b,
+    #  - only differs from the walk by lighting more: a cell lit by the walk
+    #    only has no clear line of sight, the walk letting the light go
+    #    around the corners (and mostly not seeing back from there).
+    window = fov_window(m, max_range)
+    bitmaps = m.bitmaps()
+    reach = int(max_range / 2**.5)
+    walk_only = shadowcasting_only = 0
+    for pos in positions:
+        window.offset = (max_range+2 - pos[0], max_range+2 - pos[1])
+        window.FOV = "walk"
+        walk = {p for p in window.compute_visibility(pos, max_range) if state.diag_distance(p, pos) <= reach}
+        lit = state.fov.compute(pos, bitmaps, max_range)
+        shadowcasting = {p for p in lit if state.diag_distance(p, pos) <= reach}
+        for y in range(pos[0]-max_range, pos[0]+max_range+1):
+            for x in range(pos[1]-max_range, pos[1]+max_range+1):
+                if state.fov.sees(bitmaps, pos, (y, x), max_range):
+                    assert (y, x) in lit, "%s not lit from %s" % ((y, x), pos)
+        for p in lit:
+            if not m[p].obscure:
+                assert pos in state.fov.compute(p, bitmaps, max_range), "%s lit from %s, not the other way" % (p, pos)
+        for p in walk - shadowcasting:
+            assert not state.fov.sees(bitmaps, pos, p, max_range), "%s seen from %s, only lit by the walk" % (p, pos)
+        walk_only += len(walk - shadowcasting)
+        shadowcasting_only += len(shadowcasting - walk)
+    return walk_only, shadowcasting_only
+
+def bench_fov(size=400, radii=(10, 20, 40, 80), origins=20):
+    print("fov: %sx%s map, %s origins" % (size, size, origins))
+    state.action.init_actions()
+    state.game_frame.load_map()
+    m = state.game_frame.window.map
+    rng = random.Random(0)
+    positions = rng.sample([pos for pos in m.grid.positions() if not m[pos].obscure], origins)
+    walk_only, shadowcasting_only = check_fov(m, positions)
+    report("cells lit by the walk only, radius 20", walk_only/origins, "cells")
+    report("cells lit by shadowcasting only", shadowcasting_only/origins, "cells")
+    # a door of the hero's field of view opened and closed
+    window = state.game_frame.window
+    hero = state.game_frame.get_hero().pos
+    door = min((pos for pos in state.fov.compute(hero, m.bitmaps(), 20) if m[pos].wall), key=lambda pos: state.distance(pos, hero))
+    def toggle(full):
+        for i in range(100):
+            m.set_state(door, not m[door].wall)
+            if full:
+                window.seen = None
+            window.update_seen()
+    report("door toggled, whole map lit again", timeit(lambda: toggle(True))*10, "ms")
+    report("door toggled, changed cells only", timeit(lambda: toggle(False))*10, "ms")
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, "big.mp")
+        write_big_map(file, size)
+        m = state.map.Map()
+        m.load_families()
+        m.load_tiles()
+        m.read(file)
+    positions = rng.sample([pos for pos in m.grid.positions() if not m[pos].obscure and state.diag_distance(pos, (size//2, size//2)) < size//4], origins)
+    for radius in radii:
+        window = fov_window(m, radius)
+        window.FOV = "walk"
+        def walk():
+            for pos in positions:
+                window.offset = (radius+2 - pos[0], radius+2 - pos[1])
+                window.compute_visibility(pos, radius)
+        def shadowcasting():
+            for pos in positions:
+                state.fov.compute(pos, m.bitmaps(), radius)
+        report("walk, radius %s" % radius, timeit(walk, repeat=1)*1000/origins, "ms")
+        report("shadowcasting, radius %s" % radius, timeit(shadowcasting)*1000/origins, "ms")
+    # walking back and forth between a few cells
+    window = fov_window(m, 20)
+    steps = positions[:4] * 25
+    report("radius 20, walking, no cache", timeit(lambda: [state.fov.compute(pos, m.bitmaps(), 20) for pos in steps])*1000/len(steps), "ms/step")
+    report("radius 20, walking, cache", timeit(lambda: [window.compute_visibility(pos, 20) for pos in steps])*1000/len(steps), "ms/step")
+    report("cache hits", window.fov_cache.hits*100/(window.fov_cache.hits+window.fov_cache.misses), "%")
+    # a door opened out of sight every step
+    door = positions[-1]
+    def opening():
+        for pos in steps:
+            m.set_state(door, False)
+            window.compute_visibility(pos, 20)
+    report("radius 20, walking, door opened each step", timeit(opening)*1000/len(steps), "ms/step")
+
+def bench_batch(viewers=500, size=400, radius=20, area=80):
+    print("batch: %s viewers within %sx%s cells, radius %s" % (viewers, area, area, radius))
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, "big.mp")
+        write_big_map(file, size)
+        m = state.map.Map()
+        m.load_families()
+        m.load_tiles()
+        m.read(file)
+    bitmaps = m.bitmaps()
+    rng = random.Random(0)
+    center = (size//2, size//2)
+    floors = [pos for pos in m.grid.positions() if not m[pos].obscure and state.diag_distance(pos, center) < area//2]
+    positions = rng.sample(floors, viewers)
+    hero = rng.choice(floors)
+    def fields():
+        for pos in positions:
+            hero in state.fov.compute(pos, bitmaps, radius)
+    report("hero seen, a field of view each", timeit(fields, repeat=1)*1000, "ms")
+    report("hero seen, pure Python", timeit(lambda: state.fov.visibility_bitsets(bitmaps, positions, [hero], radius, use_numpy=False))*1000, "ms")
+    if state.fov.numpy != None:
+        report("hero seen, numpy", timeit(lambda: state.fov.visibility_bitsets(bitmaps, positions, [hero], radius))*1000, "ms")
+    report("each other seen, pure Python", timeit(lambda: state.fov.visibility_bitsets(bitmaps, positions, positions, radius, use_numpy=False), repeat=1)*1000, "ms")
+    if state.fov.numpy != None:
+        report("each other seen, numpy", timeit(lambda: state.fov.visibility_bitsets(bitmaps, positions, positions, radius))*1000, "ms")
+    # lines of sight against the symmetric shadowcasting
+    pairs = agree = 0
+    for pos, bits in zip(positions[:50], state.fov.visibility_bitsets(bitmaps, positions[:50], positions, radius)):
+        field = state.fov.compute(pos, bitmaps, radius)
+        for j, target in enumerate(positions):
+            if (pos[0]-target[0])**2 + (pos[1]-target[1])**2 <= radius*radius:
+                pairs += 1
+                agree += (target in field) == bool(bits >> j & 1)
+    report("pairs agreeing with shadowcasting", agree*100/pairs, "%")
+
+def bench_walk(radius=20, starts=20):
+    print("walk: cells up to a chebyshev distance of %s, %s starts" % (radius, starts))
+    cells = (2*radius+1)**2
+    rng = random.Random(0)
+    positions = [(rng.randrange(1000), rng.randrange(1000)) for i in range(starts)]
+    def legacy():
+        for pos in positions:
+            gen = LegacyWalkGen(pos)
+            for i in range(cells):
+                next(gen)
+    def tables():
+        for pos in positions:
+            for cell in state.fov.walk(pos, radius):
+                pass
+    report("priority queue", timeit(legacy)*10**9/(starts*cells), "ns/cell")
+    report("offset tables", timeit(tables)*10**9/(starts*cells), "ns/cell")
+    state.action.init_actions()
+    state.game_frame.load_map()
+    m = state.game_frame.window.map
+    window = fov_window(m, radius)
+    window.FOV = "walk"
+    positions = rng.sample([pos for pos in m.grid.positions() if not m[pos].obscure], starts)
+    def visibility():
+        for pos in positions:
+            window.offset = (radius+2 - pos[0], radius+2 - pos[1])
+            window.compute_visibility(pos, radius)
+    def legacy_walk(start, radius=None):
+        gen = LegacyWalkGen(start)
+        while True:
+            yield next(gen)
+    walk = state.fov.walk
+    state.fov.walk = legacy_walk
+    report("walk visibility, priority queue", timeit(visibility, repeat=1)*1000/starts, "ms")
+    state.fov.walk = walk
+    report("walk visibility, offset tables", timeit(visibility)*1000/starts, "ms")
+
+def bench_los(queries=5000, radius=20):
+    print("los: %s pairs of cells of map2 in a radius of %s" % (queries, radius))
+    state.action.init_actions()
+    state.game_frame.load_map()
+    window = state.game_frame.window
+    rng = random.Random(0)
+    cells = list(window.map.grid.positions())
+    pairs = []
+    while len(pairs) < queries:
+        a, b = rng.choice(cells), rng.choice(cells)
+        if state.spatial.square_distance(a, b) <= radius*radius:
+            pairs.append((a, b))
+    def legacy():
+        # the line read through the tiles
+        for a, b in pairs:
+            all(not window.map[cell].obscure for cell in state.fov.line(a, b))
+    def cold():
+        window.line_cache = state.fov.LineCache()
+        for a, b in pairs:
+            window.los(a, b)
+    def warm():
+        for a, b in pairs:
+            window.los(b, a)
+    report("line through the tiles", timeit(legacy)*10**6/queries, "us/query")
+    report("los, new lines", timeit(cold)*10**6/queries, "us/query")
+    report("los, lines already followed", timeit(warm)*10**6/queries, "us/query")
+
+def bench_astar(maps=5, queries=100):
+    ops = state.map.GENERATE_OPS[1]
+    print("astar: %s maps of the %s, %s paths on each" % (maps, ops["name"].lower(), queries))
+    random.seed(0)
+    legacy_time = new_time = unreachable_legacy = unreachable_new = 0
+    cells = expansions = differ = 0
+    for i in range(maps):
+        tiles = ops["gen"](*ops["args"], **ops["kwargs"]).generate()
+        # a closed cell aside, which no path reaches
+        y0 = min(y for y, x in tiles) - 5
+        x0 = min(x for y, x in tiles) - 5
+        for y in range(3):
+            for x in range(3):
+                tiles[y0+y, x0+x] = state.map.Tile(state.map.WALL_TILE)
+        tiles[y0+1, x0+1] = state.map.Tile(state.map.GROUND_TILE)
+        m = state.map.Map()
+        m.set_tiles(tiles)
+        bitmaps = m.bitmaps()
+        walkable = [pos for pos, tile in tiles.items() if not tile.wall and pos != (y0+1, x0+1)]
+        cells += len(walkable)
+        pairs = [(random.choice(walkable), random.choice(walkable)) for j in range(queries)]
+        legacy = []
+        new = []
+        legacy_time += timeit(lambda: legacy.extend(legacy_a_star(m, a, b) for a, b in pairs), repeat=1)
+        before = state.metrics.counters.get("a_star.expansions", 0)
+        new_time += timeit(lambda: new.extend(state.creature.a_star(a, b, bitmaps) for a, b in pairs), repeat=1)
+        expansions += state.metrics.counters.get("a_star.expansions", 0) - before
+        differ += sum(1 for p1, p2 in zip(legacy, new) if p2 == None or len(p1) != len(p2))
+        def legacy_unreachable():
+            try:
+                legacy_a_star(m, walkable[0], (y0+1, x0+1))
+            except KeyError:
+                pass
+        unreachable_legacy += timeit(legacy_unreachable, repeat=1)
+        unreachable_new += timeit(lambda: state.creature.a_star(walkable[0], (y0+1, x0+1), bitmaps), repeat=1)
+    report("walkable cells per map", cells/maps, "cells")
+    report("path, old search", legacy_time*1000/(maps*queries), "ms/path")
+    report("path, heapq search", new_time*1000/(maps*queries), "ms/path")
+    report("cells expanded per path", expansions/(maps*queries), "cells")
+    report("paths longer than the old ones", differ, "paths")
+    report("unreachable goal, old search", unreachable_legacy*1000/maps, "ms")
+    report("unreachable goal, heapq search", unreachable_new*1000/maps, "ms")
+    state.metrics.clear()
+
+def bench_flow(chasers=50, turns=50, radius=30):
+    ops = state.map.GENERATE_OPS[1]
+    print("flow: %s creatures chasing a target for %s turns on a %s" % (chasers, turns, ops["name"].lower()))
+    random.seed(0)
+    tiles = ops["gen"](*ops["args"], **ops["kwargs"]).generate()
+    m = state.map.Map()
+    m.set_tiles(tiles)
+    bitmaps = m.bitmaps()
+    walkable = [pos for pos, tile in tiles.items() if not tile.wall]
+    # the target walks around, each chaser within radius
+    targets = [random.choice(walkable)]
+    while len(targets) < turns:
+        moves = [pos for pos in (state.add_tuples(targets[-1], dir) for dir in (state.UP, state.RIGHT, state.DOWN, state.LEFT)) if pos in tiles and not tiles[pos].wall]
+        targets.append(random.choice(moves))
+    field = state.flow.Field(targets[0], bitmaps, radius)
+    starts = random.sample([pos for pos in walkable if pos in field], chasers)
+    def searches():
+        for target in targets:
+            for start in starts:
+                state.creature.a_star(start, target, bitmaps)
+    def fields():
+        for target in targets:
+            field = state.flow.Field(target, bitmaps, radius)
+            for start in starts:
+                field.towards(start)
+    report("a path per chaser", timeit(searches, repeat=1)*1000/turns, "ms/turn")
+    report("a field shared by the chasers", timeit(fields, repeat=1)*1000/turns, "ms/turn")
+    report("field", timeit(lambda: state.flow.Field(targets[0], bitmaps, radius))*1000, "ms")
+    report("flee map", timeit(lambda: state.flow.Field(targets[0], bitmaps, radius).flee())*1000, "ms")
+    # following the field takes as many steps as the shortest path
+    differ = 0
+    for start in starts:
+        pos = start
+        steps = 0
+        while pos != targets[0]:
+            pos = field.towards(pos)[0]
+            steps += 1
+        differ += steps != len(state.creature.a_star(start, targets[0], bitmaps))
+    report("walks longer than the shortest path", differ, "walks")
+    # fleeing: each step lowers the flee map, so that the walk ends (where
+    # no neighbour is lower) farther from the target than it started; a step
+    # may still get closer, going past the target towards a farther way out
+    closer = 0
+    for start in field:
+        pos = start
+        flee = field.flee()
+        while field.away(pos):
+            next = field.away(pos)[0]
+            assert flee[bitmaps.index(next)] < flee[bitmaps.index(pos)]
+            closer += field.distance(next) < field.distance(pos)
+            pos = next
+        assert pos == start or field.distance(pos) > field.distance(start), (start, pos)
+    report("flee steps getting closer", closer, "steps")
+    state.metrics.clear()
+
+def bench_pursuit(rows=20, length=60, turns=200):
+    print("pursuit: a target fled along a corridor of %sx%s cells for %s turns" % (rows, length, turns))
+    tiles, doors = corridor_tiles(rows, length)
+    m = state.map.Map()
+    m.set_tiles(tiles)
+    # the pursuer starts at one end, the target halfway, walking away from it
+    # and back; then again, a door opening every 20 turns
+    random.seed(0)
+    cells = [(2*row+1, x if row % 2 == 0 else length+1-x) for row in range(rows) for x in range(1, length+1)]
+    moves = []
+    i = len(cells)//2
+    for turn in range(turns):
+        i = max(0, min(len(cells)-1, i + random.choice((1, 1, -1))))
+        moves.append(cells[i])
+    def chase(step, toggle=False, check=False):
+        # the cells of the pursuer turn by turn; with check, each step is
+        # checked against the distances to the target found breadth first
+        pos = cells[0]
+        toggled = 0
+        positions = []
+        for turn, target in enumerate(moves):
+            if toggle and turn % 20 == 19:
+                door = doors[toggled % len(doors)]
+                m.set_state(door, not m[door].wall)
+                toggled += 1
+            next = step(pos, target)
+            if check:
+                field = state.flow.Field(target, m.bitmaps(), len(tiles))
+                if next == None:
+                    assert pos == target or field.distance(pos) == None, (turn, pos, target)
+                else:
+                    assert field.distance(next) == field.distance(pos) - 1, (turn, pos, next, target)
+            if next != None and next != target:
+                pos = next
+            positions.append(pos)
+        for door in doors:
+            m.set_state(door, True)
+        return positions
+    def search(pos, target):
+        path = state.creature.a_star(pos, target, m.bitmaps())
+        return path[0] if path else None
+    for toggle in (False, True):
+        planner = state.pursuit.Planner()
+        def repair(pos, target):
+            return planner.next_step(pos, target, m)
+        suffix = ", doors opened" if toggle else ""
+        state.metrics.clear()
+        report("a search per turn" + suffix, timeit(lambda: chase(search, toggle), repeat=1)*1000/turns, "ms/turn")
+        report("cells expanded per turn", state.metrics.counters["a_star.expansions"]/turns, "cells")
+        report("planner repaired" + suffix, timeit(lambda: chase(repair, toggle), repeat=1)*1000/turns, "ms/turn")
+        report("cells expanded per turn", planner.expansions/turns, "cells")
+        report("searches from scratch", planner.searches, "searches")
+        searched = chase(search, toggle, True)
+        repaired = chase(repair, toggle, True)
+        # the same cells turn by turn, not only at the end
+        assert searched == repaired, next(turn for turn in range(turns) if searched[turn] != repaired[turn])
+        report("same pursuit", len(repaired), "turns")
+    state.metrics.clear()
+
+def bench_metrics(calls=100000):
+    print("metrics: %s calls" % calls)
+    def nothing():
+        pass
+    timed = state.metrics.timed("bench")(nothing)
+    def bare():
+        for i in range(calls):
+            nothing()
+    def measured():
+        for i in range(calls):
+            timed()
+    report("bare call", timeit(bare)*10**9/calls, "ns/call")
+    report("timed call", timeit(measured)*10**9/calls, "ns/call")
+    report("report", timeit(state.metrics.lines)*10**6, "us")
+    state.metrics.clear()
+    state.metrics.enabled = False
+    report("timed call, metrics disabled", timeit(measured)*10**9/calls, "ns/call")
+    state.metrics.count("bench")
+    state.metrics.sample("bench", 1)
+    # nothing is recorded while disabled
+    assert not state.metrics.timers and not state.metrics.counters, state.metrics.report()
+    state.metrics.enabled = True
+    state.metrics.clear()
+
+def bench_bitmaps(size=400, lookups=200000):
+    print("bitmaps: %sx%s map, %s lookups" % (size, size, lookups))
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, "big.mp")
+        write_big_map(file, size)
+        m = state.map.Map()
+        m.load_families()
+        m.load_tiles()
+        m.read(file)
+    report("build", timeit(lambda: grid.Bitmaps(m.grid))*1000, "ms")
+    rng = random.Random(0)
+    positions = [(rng.randrange(size), rng.randrange(size)) for i in range(lookups)]
+    doors = rng.sample(list(m.grid.positions()), 100)
+    def tiles():
+        for pos in positions:
+            m[pos] and not m[pos].wall
+    bitmaps = m.bitmaps()
+    def bitmap():
+        walkable = bitmaps.walkable
+        for pos in positions:
+            walkable[(pos[0]-bitmaps.y0)*bitmaps.width + pos[1]-bitmaps.x0]
+    report("walkable, tiles", timeit(tiles)*10**9/lookups, "ns/lookup")
+    report("walkable, bitmap", timeit(bitmap)*10**9/lookups, "ns/lookup")
+    def toggle():
+        for pos in doors:
+            m.set_state(pos, not m[pos].wall)
+            m.bitmaps()
+    report("cell changed, bitmaps updated", timeit(toggle)*10**6/len(doors), "us/cell")
+
+def legacy_spawn(holder, **kwargs):
+    # a creature built as it used to be, every default looked up by name
+    attributes = holder.args.copy()
+    attributes.update(kwargs)
+    creature = holder.ai.__new__(holder.ai)
+    creature.CREATURE_ATTRIBUTES = holder.ai.CREATURE_ATTRIBUTES.union(set())
+    for key in attributes.keys():
+        if key not in creature.CREATURE_ATTRIBUTES:
+            raise NameError("Attribute %s doesn't exist" % key)
+    for key in creature.CREATURE_ATTRIBUTES:
+        setattr(creature, key, getattr(creature, "DEFAULT_"+key.upper())())
+    for key, value in attributes.items():
+        setattr(creature, key, getattr(creature, "DEFAULT_"+key.upper()).load(value))
+    # empty slots used to hold an item each
+    creature.inventory.slots = {slot: state.items.NoneItem() for slot in state.items.SLOTS}
+    creature.triggers = {}
+    for trigger in holder.triggers.items():
+        creature.add_trigger(*trigger)
+    return creature
+
+def bench_spawn(count=10000):
+    print("spawn: %s creatures of each kind" % count)
+    for creature_id, holder in sorted(state.creature.creature_map.items()):
+        if not isinstance(holder, state.creature.CreatureHolder):
+            continue
+        legacy = timeit(lambda: [legacy_spawn(holder, pos=(1, 1)) for i in range(count)])
+        compiled = timeit(lambda: [holder(pos=(1, 1)) for i in range(count)])
+        report("%s, legacy" % holder.DEFAULT_STR(), legacy*10**6/count, "us/creature")
+        report("%s, defaults table (x%.1f)" % (holder.DEFAULT_STR(), legacy/compiled), compiled*10**6/count, "us/creature")
+
+def bench_savefile(count=100000):
+    print("savefile: %s creatures" % count)
+    rng = random.Random(0)
+    holders = [holder for holder in state.creature.creature_map.values() if isinstance(holder, state.creature.CreatureHolder)]
+    hero = state.creature.Hero(pos=(0, 0))
+    hero.inventory.inventory = [state.items.get_item("sword")]*3
+    creatures = [hero.save()] + [rng.choice(holders)(pos=(rng.randrange(1000), rng.randrange(1000)), uuid=uuid).save() for uuid in range(1, count)]
+    for creature in creatures[::10]:
+        creature["inventory"] = hero.save()["inventory"]
+    rows = io.StringIO()
+    columns = io.StringIO()
+    report("rows, encode", timeit(lambda: rows.write(json.dumps({"creatures": creatures, "items": []})), repeat=1), "s")
+    report("columns, encode", timeit(lambda: savefile.write_objs(columns.write, creatures, []), repeat=1), "s")
+    report("rows, size", len(rows.getvalue())/2**20, "MiB")
+    report("columns, size", len(columns.getvalue())/2**20, "MiB")
+    report("rows, decode", timeit(lambda: json.loads(rows.getvalue()), repeat=1), "s")
+    report("columns, decode", timeit(lambda: savefile.read_objs(io.StringIO(columns.getvalue()).readline), repeat=1), "s")
+    # only the first block is decoded before the first entity is used
+    report("columns, streamed, first entity", timeit(lambda: next(savefile.stream_objs(io.StringIO(columns.getvalue()).readline)[1]))*1000, "ms")
+
+IMPORT = """
+import sys, time
+opened = []
+def audit(event, args):
+    if event == "open" and isinstance(args[0], str) and not args[0].endswith((".py", ".pyc")):
+        opened.append(args[0])
+sys.addaudithook(audit)
+t = time.perf_counter()
+import state, map, creature
+# numpy is imported by the components store on first use only
+assert "numpy" not in sys.modules
+print(time.perf_counter()-t, len(opened))
+"""
+
+def first_frame(marker=b"Turns:", timeout=10):
+    # time until main.py draws its first frame in a pseudo terminal
+    t = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.chdir(state.BASEDIR)
+        os.environ["TERM"] = "xterm"
+        os.execv(sys.executable, [sys.executable, "main.py"])
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack("HHHH", NullScreen.size[0], NullScreen.size[1], 0, 0))
+    output = b""
+    try:
+        while marker not in output:
+            if time.perf_counter()-t > timeout or not select.select([fd], [], [], timeout)[0]:
+                raise RuntimeError("main.py didn't draw a frame")
+            output += os.read(fd, 65536)
+        return time.perf_counter()-t
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        os.close(fd)
+
+def bench_import(runs=10):
+    print("import: state, map and creature in a new process, %s runs" % runs)
+    best, opened = float("inf"), 0
+    for i in range(runs):
+        result = subprocess.run([sys.executable, "-c", IMPORT], cwd=state.BASEDIR, check=True, capture_output=True, text=True)
+        duration, opened = result.stdout.split()
+        best = min(best, float(duration))
+    report("import time", best*1000, "ms")
+    report("files opened (not modules)", int(opened), "files")
+    report("main.py, first frame", timeit(first_frame, repeat=runs)*1000, "ms")
+
+BENCHMARKS = {
+    "grid": bench_grid,
+    "tiles": bench_tiles,
+    "mapfile": bench_mapfile,
+    "assets": bench_assets,
+    "startup": bench_startup,
+    "import": bench_import,
+    "autotile": bench_autotile,
+    "levels": bench_levels,
+    "spatial": bench_spatial,
+    "components": bench_components,
+    "spawn": bench_spawn,
+    "savefile": bench_savefile,
+    "fov": bench_fov,
+    "bitmaps": bench_bitmaps,
+    "batch": bench_batch,
+    "walk": bench_walk,
+    "los": bench_los,
+    "astar": bench_astar,
+    "flow": bench_flow,
+    "pursuit": bench_pursuit,
+    "metrics": bench_metrics,
+}
+
+if __name__ == "__main__":
+    headless()
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,192 @@
+### Components module
+# Optional storage of the hot numeric stats of the creatures in contiguous
+# arrays, one slot per creature, so that bulk operations (area damage,
+# regeneration...) are passes over arrays instead of method calls.
+# A creature bound to a store keeps these stats in the store only, its
+# attributes becoming views of its slot.
+# A column holds integers ("q") until a float is stored into it, when it
+# becomes a column of floats ("d"). The passes over the columns run on
+# numpy views of them when numpy is there, numpy being imported on the
+# first pass only as it is slow to import.
+
+import array
+
+# numpy once imported by load_numpy, None until then, False when it isn't
+# there
+numpy = None
+
+def load_numpy():
+    # numpy, None without it; the passes loop over the arrays then
+    global numpy
+    if numpy == None:
+        try:
+            import numpy as module
+        except ImportError:
+            module = False
+        numpy = module
+    return numpy or None
+
+# stats kept in the arrays, the position being split in two arrays (y, x)
+STATS = ("life", "max_life", "armor", "resistance", "strenght", "speed")
+
+class Component:
+    # attribute of a creature, read from its slot once bound to a store
+    def __init__(self, name):
+        self.name = name
+    def __get__(self, creature, owner=None):
+        if creature is None:
+            return self
+        store = creature.__dict__.get("component_store")
+        if store is None:
+            try:
+                return creature.__dict__[self.name]
+            except KeyError:
+                raise AttributeError(self.name)
+        return store.stats[self.name][creature.component_slot]
+    def __set__(self, creature, value):
+        store = creature.__dict__.get("component_store")
+        if store is None:
+            creature.__dict__[self.name] = value
+        else:
+            store.set(self.name, creature.component_slot, value)
+
+class PosComponent(Component):
+    def __init__(self):
+        Component.__init__(self, "pos")
+    def __get__(self, creature, owner=None):
+        if creature is None:
+            return self
+        store = creature.__dict__.get("component_store")
+        if store is None:
+            try:
+                return creature.__dict__["pos"]
+            except KeyError:
+                raise AttributeError("pos")
+        slot = creature.component_slot
+        return store.ys[slot], store.xs[slot]
+    def __set__(self, creature, value):
+        store = creature.__dict__.get("component_store")
+        if store is None:
+            creature.__dict__["pos"] = value
+        else:
+            slot = creature.component_slot
+            store.ys[slot], store.xs[slot] = value
+
+class ComponentStore:
+    def __init__(self):
+        self.stats = {name: array.array("q") for name in STATS}
+        self.ys = array.array("q")
+        self.xs = array.array("q")
+        # 1 for the slots in use
+        self.used = bytearray()
+        # slot -> creature, None for a free slot
+        self.creatures = []
+        self.free = []
+    def __len__(self):
+        return len(self.creatures) - len(self.free)
+    def column(self, name, value):
+        # the column of `name', made a column of floats first if value is one
+        column = self.stats[name]
+        if column.typecode == "q" and isinstance(value, float):
+            column = self.stats[name] = array.array("d", column)
+        return column
+    def set(self, name, slot, value):
+        self.column(name, value)[slot] = value
+    def bind(self, creature):
+        # moves the stats of `creature' into a slot
+        if creature.__dict__.get("component_store") is not None:
+            return
+        values = [creature.__dict__.pop(name) for name in STATS]
+        y, x = creature.__dict__.pop("pos")
+        if self.free:
+            slot = self.free.pop()
+            for name, value in zip(STATS, values):
+                self.set(name, slot, value)
+            self.ys[slot], self.xs[slot] = y, x
+            self.used[slot] = 1
+            self.creatures[slot] = creature
+        else:
+            slot = len(self.creatures)
+            for name, value in zip(STATS, values):
+                self.column(name, value).append(value)
+            self.ys.append(y)
+            self.xs.append(x)
+            self.used.append(1)
+            self.creatures.append(creature)
+        creature.component_slot = slot
+        creature.component_store = self
+    def unbind(self, creature):
+        # gives `creature' its stats back, freeing its slot
+        if creature.__dict__.get("component_store") is not self:
+            return
+        slot = creature.component_slot
+        del creature.component_store
+        del creature.component_slot
+        for name in STATS:
+            creature.__dict__[name] = self.stats[name][slot]
+        creature.__dict__["pos"] = (self.ys[slot], self.xs[slot])
+        self.used[slot] = 0
+        self.creatures[slot] = None
+        self.free.append(slot)
+    def clear(self):
+        for creature in self.creatures:
+            if creature is not None:
+                self.unbind(creature)
+        ComponentStore.__init__(self)
+    def view(self, name):
+        # numpy view of a column, to be dropped before the store changes
+        column = self.stats[name]
+        return load_numpy().frombuffer(column, dtype=column.typecode)
+    def in_radius(self, pos, radius):
+        # slots in use at an euclidian distance of at most `radius' from pos
+        y0, x0 = pos
+        square = radius*radius
+        numpy = load_numpy()
+        if numpy != None:
+            ys = numpy.frombuffer(self.ys, dtype="q")
+            xs = numpy.frombuffer(self.xs, dtype="q")
+            used = numpy.frombuffer(self.used, dtype=numpy.uint8)
+            return numpy.flatnonzero(used.astype(bool) & ((ys-y0)**2 + (xs-x0)**2 <= square)).tolist()
+        return [slot for slot, (y, x, used) in enumerate(zip(self.ys, self.xs, self.used)) if used and (y-y0)**2 + (x-x0)**2 <= square]
+    def realdamage(self, slots, damage):
+        # the damage each creature of `slots' takes from `damage', reduced by
+        # its armor and resistance as Creature.compute_realdamage does
+        armor = self.stats["armor"]
+        resistance = self.stats["resistance"]
+        numpy = load_numpy()
+        if numpy != None:
+            slots = numpy.array(slots, dtype=numpy.intp)
+            reduced = 100/(100+self.view("armor")[slots])*damage - self.view("resistance")[slots]
+            # numpy.round rounds halves to even, as round does
+            return numpy.round(numpy.maximum(reduced, 0)).astype(int).tolist()
+        return [int(round(max(100/(100+armor[slot])*damage - resistance[slot], 0), 0)) for slot in slots]
+    def damage(self, slots, damage):
+        # applies `damage' to the creatures of `slots' at once, without the
+        # messages of Creature.take_damage; returns the slots whose life
+        # dropped to 0 or less
+        damages = self.realdamage(slots, damage)
+        numpy = load_numpy()
+        if numpy != None:
+            slots = numpy.array(slots, dtype=numpy.intp)
+            life = self.view("life")
+            life[slots] -= numpy.array(damages, dtype=life.dtype)
+            return slots[life[slots] <= 0].tolist()
+        life = self.stats["life"]
+        dead = []
+        for slot, loss in zip(slots, damages):
+            life[slot] -= loss
+            if life[slot] <= 0:
+                dead.append(slot)
+        return dead
+    def regenerate(self, amount):
+        # every creature gains `amount' life, up to its max_life
+        life = self.column("life", amount)
+        if self.stats["max_life"].typecode == "d":
+            life = self.column("life", 0.0)
+        numpy = load_numpy()
+        if numpy != None:
+            view = self.view("life")
+            used = numpy.frombuffer(self.used, dtype=numpy.uint8).astype(bool)
+            view[used] = numpy.minimum(view[used] + amount, self.view("max_life")[used])
+            return
+        self.stats["life"] = array.array(life.typecode, [min(value + amount, max_life) if used else value for value, max_life, used in zip(life, self.stats["max_life"], self.used)])
@@ -1,45 +1,83 @@
-import state, random, items, queue, items, os
+import state, random, items, heapq, assets, components
 
-def options(pos):
-    for dir in {state.UP, state.RIGHT, state.DOWN, state.LEFT}:
-        newpos = state.add_tuples(pos, dir)
-        if state.game_frame.window.map[newpos] and not state.game_frame.window.map[newpos].wall:
-            yield newpos
+# expansions after which a_star gives up, the goal being too far
+MAX_EXPANSIONS = 20000
+# part of its max life under which an AutoCreature flees its ennemy
+FLEE_LIFE = 0.25
 
 def heuristic(pos, goal):
+    # manhattan distance, never more than the length of a path made of
+    # steps up, right, down and left
     y1, x1 = pos
-    y2, x2 = pos
+    y2, x2 = goal
     return abs(y1-y2)+abs(x1-x2)
-            
-def a_star(start, end):
-    border = queue.PriorityQueue()
-    border.put_nowait((0, start))
-    came_from = {start: None}
-    cost_so_far = {start: 0}
-    while border.qsize() > 0:
-        distance, current = border.get_nowait()
-        if current == end:
+
+@state.metrics.timed("a_star")
+def a_star(start, end, bitmaps=None, max_expansions=MAX_EXPANSIONS):
+    # path from start to end (start excluded) over the walkable bitmap of
+    # the current map, None if there is none within max_expansions
+    # expansions; nodes are indexes of the bitmap, whose border isn't
+    # walkable, so the neighbours of a node are never out of it.
+    # Nothing in the game calls it: the creatures chase and flee with
+    # flow.Field and pursuit.Planner. It is kept for tools and benchmarks,
+    # being the reference they are checked against in bench.py (astar,
+    # flow, pursuit); its timer and counters only record there.
+    if bitmaps == None:
+        bitmaps = state.game_frame.window.map.bitmaps()
+    walkable = bitmaps.walkable
+    goal = bitmaps.index(end)
+    if not bitmaps.inside(start) or goal == None or not walkable[goal]:
+        state.metrics.count("a_star.no_path")
+        return None
+    first = bitmaps.index(start)
+    width = bitmaps.width
+    gy, gx = divmod(goal, width)
+    steps = (-width, 1, width, -1)
+    distance = heuristic(start, end)
+    border = [(distance, distance, first)]
+    came_from = {first: -1}
+    cost_so_far = {first: 0}
+    expansions = 0
+    path = None
+    while border:
+        priority, distance, current = heapq.heappop(border)
+        if current == goal:
+            path = reconstruct_path(came_from, bitmaps, goal)
+            break
+        cost = priority - distance
+        if cost > cost_so_far[current]:
+            # already expanded through a shorter path
+            continue
+        expansions += 1
+        if expansions > max_expansions:
             break
-        for next in options(current):
-            new_cost = cost_so_far[current] + 1
-            if next not in cost_so_far or new_cost < cost_so_far[next]:
-                cost_so_far[next] = new_cost
+        cost += 1
+        for step in steps:
+            next = current + step
+            if walkable[next] and (next not in cost_so_far or cost < cost_so_far[next]):
+                cost_so_far[next] = cost
                 came_from[next] = current
-                border.put_nowait((heuristic(next, end) + new_cost, next))
-    return came_from
+                y, x = divmod(next, width)
+                distance = abs(y-gy) + abs(x-gx)
+                # ties broken towards the goal
+                heapq.heappush(border, (cost + distance, distance, next))
+    state.metrics.count("a_star.expansions", expansions)
+    if path == None:
+        state.metrics.count("a_star.no_path")
+    return path
 
-def reconstruct_path(came_from, start, end):
-    current = end
+def reconstruct_path(came_from, bitmaps, goal):
+    current = goal
     path = []
-    while current != start:
-        path.append(current)
+    while came_from[current] != -1:
+        path.append(bitmaps.pos(current))
         current = came_from[current]
     path.reverse()
     return tuple(path)
 
 def shortest_path(start, end):
-    came_from = a_star(start, end)
-    return reconstruct_path(came_from, start, end)
+    # None if end can't be reached from start; for tools, see a_star
+    return a_star(start, end)
 
 class RemoveCorpse(BaseException):
     pass
@@ -58,6 +96,55 @@ class SaveInterface:
     def copy(self):
         return type(self)(self.value_type, self.save_type, self.value)
 
+# default values which can be shared between creatures
+IMMUTABLE = (bool, int, float, str, tuple, type(None))
+
+def compile_defaults(source, attributes):
+    # defaults table of `attributes', source holding their DEFAULT_*:
+    # (shared values, [(attribute, load, value)] built for each creature,
+    # loaders)
+    constants = {}
+    builders = []
+    loaders = {}
+    for key in attributes:
+        default = getattr(source, "DEFAULT_"+key.upper())
+        loaders[key] = default.load
+        value = default()
+        if type(value) in IMMUTABLE:
+            constants[key] = value
+        else:
+            builders.append((key, default.load, default.value))
+    return constants, builders, loaders
+
+def fold_defaults(defaults, attributes):
+    # defaults table with `attributes' as defaults, loaded once
+    constants, builders, loaders = defaults
+    for key in attributes:
+        if key not in loaders:
+            raise NameError("Attribute %s doesn't exist" % key)
+    constants = dict(constants)
+    builders = [builder for builder in builders if builder[0] not in attributes]
+    for key, value in attributes.items():
+        loaded = loaders[key](value)
+        if type(loaded) in IMMUTABLE:
+            constants[key] = loaded
+        else:
+            constants.pop(key, None)
+            builders.append((key, loaders[key], value))
+    return constants, builders, loaders
+
+class LazyAttribute:
+    # attribute built from the lazy_defaults of the creature on first
+    # access, then kept in its __dict__ (which is looked at first)
+    def __init__(self, name):
+        self.name = name
+    def __get__(self, creature, owner=None):
+        if creature is None:
+            return self
+        load, value = creature.lazy_defaults[self.name]
+        value = creature.__dict__[self.name] = load(value)
+        return value
+
 class Constructor:
     def __init__(self, type, args):
         self.type = type
@@ -91,25 +178,40 @@ class Creature:
     DEFAULT_EFFECTS = SaveInterface(list, list, [])
     DEFAULT_ALIVE = SaveInterface(bool, bool, True)
     CREATURE_ATTRIBUTES = {"is_pickable", "char", "pos", "color", "speed", "life", "max_life", "mana", "max_mana", "str", "armor", "resistance", "strenght", "max_weight", "weight", "inventory", "_dead", "creature_id", "uuid", "is_hero", "is_walkable", "effects", "alive"}
+    # kept in GameFrame.component_store when there is one
+    life = components.Component("life")
+    max_life = components.Component("max_life")
+    armor = components.Component("armor")
+    resistance = components.Component("resistance")
+    strenght = components.Component("strenght")
+    speed = components.Component("speed")
+    pos = components.PosComponent()
     def exec_trigger(self, trigger):
         cmd = trigger.split(" ",1)[0]
         args = trigger.split(" ",1)[1:]
         if cmd == "summon":
-            crt = creature_map[int(args[0])](pos=self.pos)
+            crt = registry()[0][int(args[0])](pos=self.pos)
             state.game_frame.create_creature(crt)
     def add_trigger(self, trigger, effect):
         self.triggers[trigger] = effect
-    def __init__(self, **attributes):
-        for key in attributes.keys():
-            if key not in self.CREATURE_ATTRIBUTES:
+    @classmethod
+    def defaults_table(cls):
+        # computed once per class
+        if "DEFAULTS" not in cls.__dict__:
+            cls.DEFAULTS = compile_defaults(cls, cls.CREATURE_ATTRIBUTES)
+        return cls.DEFAULTS
+    def __init__(self, defaults=None, **attributes):
+        # defaults: table of compile_defaults, the one of the class if None
+        constants, builders, loaders = defaults or self.defaults_table()
+        for key in attributes:
+            if key not in loaders:
                 raise NameError("Attribute %s doesn't exist" % key)
-        for key in self.CREATURE_ATTRIBUTES:
-            attr = getattr(self, "DEFAULT_"+key.upper())
-            value = attr()
-            setattr(self, key, value)
+        self.__dict__.update(constants)
+        for key, load, value in builders:
+            if key not in attributes:
+                self.__dict__[key] = load(value)
         for key, value in attributes.items():
-            dattr = getattr(self, "DEFAULT_"+key.upper())
-            setattr(self, key, dattr.load(value))
+            self.__dict__[key] = loaders[key](value)
         self.triggers = {}
         self._post_init()
     def is_dead(self):
@@ -148,6 +250,7 @@ class Creature:
         state.game_frame.window.map[self.pos].remove_creature(self.uuid)
         self.pos = state.add_tuples(self.pos, dir)
         state.game_frame.window.map[self.pos].add_creature(self.uuid)
+        state.game_frame.creature_index.move(self.uuid, self.pos)
     def compute_armor(self, damage):
         return 100/(100+self.armor)*damage
     def compute_resistance(self, damage):
@@ -197,33 +300,54 @@ class Hero(Creature):
 
 class AutoCreature(Creature):
     DEFAULT_ENNEMY = SaveInterface(int, int, -1)
+    # not used anymore (see next_step), kept for the saves having it
     DEFAULT_PATH = SaveInterface(tuple, list, tuple())
+    CREATURE_ATTRIBUTES = Creature.CREATURE_ATTRIBUTES.union({"ennemy", "path"})
     def __init__(self, *args, **kwargs):
-        self.CREATURE_ATTRIBUTES = self.CREATURE_ATTRIBUTES.union({"ennemy", "path"})
         Creature.__init__(self, *args, **kwargs)
-        self.target_pos = None
-        self.path_step = -1
+        # pursuit.Planner of the way to the ennemy, made on first use
+        self.planner = None
     def react_to_attack(self, damage, source):
         self.ennemy = source
-    def compute_path(self):
-        self.target_pos = state.game_frame.get_creature(self.ennemy).pos
-        self.path = shortest_path(self.pos, self.target_pos)
-        self.path_step = 0
+    def next_step(self, target):
+        # the cell to go to towards target, None if there is no way
+        if self.planner == None:
+            self.planner = state.pursuit.Planner()
+        return self.planner.next_step(self.pos, target, state.game_frame.window.map)
+    def flee(self, target):
+        # steps away from target along its flee map; False when cornered or
+        # out of the field
+        field = state.game_frame.window.flow_field(target)
+        for next in field.away(self.pos):
+            if state.game_frame.is_walkable(next):
+                self.move(state.sub_tuples(next, self.pos))
+                return True
+        return False
     def take_turn(self):
         if self.is_dead():
             return []
         if self.ennemy!=-1 and (not state.game_frame.exists(self.ennemy) or state.game_frame.get_creature(self.ennemy).is_dead()):
             self.ennemy = -1
+        if self.ennemy!=-1 and self.life <= self.max_life*FLEE_LIFE and self.flee(state.game_frame.get_creature(self.ennemy).pos):
+            return [(self.speed, self.take_turn)]
         if self.ennemy!=-1 and state.distance(state.game_frame.get_creature(self.ennemy).pos, self.pos) < 3:
             self.attack(self.ennemy)
             return [(self.speed, self.take_turn)]
         elif self.ennemy!=-1:
-            if state.game_frame.get_creature(self.ennemy).pos != self.target_pos:
-                self.compute_path()
-            if state.game_frame.is_walkable(self.path[self.path_step]):
-                self.move(state.sub_tuples(self.path[self.path_step], self.pos))
-                self.path_step += 1
-            return [(self.speed, self.take_turn)]
+            field = state.game_frame.window.flow_field(state.game_frame.get_creature(self.ennemy).pos)
+            if self.pos in field:
+                for next in field.towards(self.pos):
+                    if state.game_frame.is_walkable(next):
+                        self.move(state.sub_tuples(next, self.pos))
+                        break
+                return [(self.speed, self.take_turn)]
+            # too far from its ennemy for the field; no way: the creature
+            # wanders
+            next = self.next_step(state.game_frame.get_creature(self.ennemy).pos)
+            if next != None:
+                if state.game_frame.is_walkable(next):
+                    self.move(state.sub_tuples(next, self.pos))
+                return [(self.speed, self.take_turn)]
             
         moves = [state.UP, state.RIGHT, state.LEFT, state.DOWN]
         random.shuffle(moves)
@@ -246,14 +370,15 @@ class CreatureHolder:
             save_int.value = value
             setattr(self, rattr, save_int)
         self.triggers = {}
+        # defaults table of the ai, the args included, see compile_defaults
+        self.defaults = None
     def add_trigger(self, trigger, effect):
         self.triggers[trigger] = effect
     def __call__(self, *args, **kwargs):
-        kargs = self.args.copy()
-        kargs.update(kwargs)
-        ai = self.ai(*args, **kargs)
-        for trigger in self.triggers.items():
-            ai.add_trigger(*trigger)
+        if self.defaults == None:
+            self.defaults = compile_defaults(self, self.ai.CREATURE_ATTRIBUTES)
+        ai = self.ai(*args, defaults=self.defaults, **kwargs)
+        ai.triggers.update(self.triggers)
         return ai
     
 """
@@ -289,11 +414,33 @@ class Item(Creature):
     DEFAULT_ALIVE = SaveInterface(bool, bool, False)
     DEFAULT_NAME = SaveInterface(str, str, "sword")
     DEFAULT_ICON = SaveInterface(str, str, ")")
-    def __init__(self, **attributes):
+    CREATURE_ATTRIBUTES = Creature.CREATURE_ATTRIBUTES.union({"attributes", "item", "name", "icon"})
+    # an item on the floor seldom has these looked at: they are built on
+    # first access only
+    attributes = LazyAttribute("attributes")
+    effects = LazyAttribute("effects")
+    inventory = LazyAttribute("inventory")
+    # (table, entity) ids -> (table, entity, table with the entity folded in)
+    ENTITY_DEFAULTS = {}
+    def __init__(self, defaults=None, **attributes):
+        # the entity of the item overrides the attributes given
         self.ritem = state.items.get_item(attributes.get("item", "sword"))
-        attributes.update(self.ritem.entity)
-        self.CREATURE_ATTRIBUTES = self.CREATURE_ATTRIBUTES.union({"attributes", "item", "name", "icon"})
-        Creature.__init__(self, **attributes)
+        entity = self.ritem.entity
+        defaults = defaults or self.defaults_table()
+        folded = self.ENTITY_DEFAULTS.get((id(defaults), id(entity)))
+        if folded == None or folded[0] is not defaults or folded[1] != entity:
+            folded = self.ENTITY_DEFAULTS[id(defaults), id(entity)] = (defaults, dict(entity), self.lazy_table(fold_defaults(defaults, entity)))
+        for key in entity:
+            attributes.pop(key, None)
+        Creature.__init__(self, folded[2], **attributes)
+    @staticmethod
+    def lazy_table(defaults):
+        # the builders of the LazyAttributes moved to lazy_defaults
+        constants, builders, loaders = defaults
+        lazy = {key: (load, value) for key, load, value in builders if isinstance(getattr(Item, key, None), LazyAttribute)}
+        constants = dict(constants, lazy_defaults=lazy)
+        builders = [builder for builder in builders if builder[0] not in lazy]
+        return constants, builders, loaders
     def take_turn(self):
         return []
 
@@ -303,18 +450,6 @@ ais = {
     "idle": Creature
 }
 
-def crt2dict(crt):
-    crt = crt.replace("\n", "")
-    while "  " in crt:
-        crt.replace("  ", " ")
-    result = {}
-    for entry in crt.split(";;"):
-        if not entry.replace(" ","").replace("\t", ""): continue
-        key, value = entry.split(" ", 1)
-        value = eval(value)
-        result[key] = value
-    return result
-
 def load_creatures():
     global creature, creature_map, alive_creatures
 
@@ -327,22 +462,26 @@ def load_creatures():
 
     creatures = {}
 
-    pwd, _, files = next(os.walk(os.path.join(state.BASEDIR, "creatures/")))
-    for file in files:
-        if not file.endswith(".crt"):
-            continue
-        with open(os.path.join(pwd, file)) as f:
-            c = f.read()
-        crt_name = file[:-4]
-        crt = crt2dict(c)
-        ai = ais[crt["ai"]]
-        args = {key: value for key, value in crt.items() if key in ai.CREATURE_ATTRIBUTES}
+    for crt_name, crt in assets.load_creatures().items():
+        ai = ais[crt.ai]
+        args = {key: value for key, value in crt.attributes.items() if key in ai.CREATURE_ATTRIBUTES}
 
         creatures[crt_name] = CreatureHolder(ai,args)
-        creature_map[crt["creature_id"]] = creatures[crt_name]
+        creature_map[crt.creature_id] = creatures[crt_name]
         if args.get("alive", True):
-            alive_creatures.add(crt["creature_id"])
-        for arg in crt.keys():
-            if arg.startswith("on_"):
-                creatures[crt_name].add_trigger(arg[3:], crt[arg])
-load_creatures()
+            alive_creatures.add(crt.creature_id)
+        for trigger, effect in crt.triggers.items():
+            creatures[crt_name].add_trigger(trigger, effect)
+
+# creature_map and alive_creatures are loaded on first use
+def registry():
+    if "creature_map" not in globals():
+        load_creatures()
+    return creature_map, alive_creatures
+
+def __getattr__(name):
+    if name == "creature_map":
+        return registry()[0]
+    if name == "alive_creatures":
+        return registry()[1]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,108 @@
+### Flow module
+# Dijkstra maps: the number of steps from every walkable cell to a target,
+# up to a radius, so that the creatures going to (or fleeing from) the same
+# target step to their lowest neighbour instead of each searching a path.
+# A map is computed once per target position and revision of the map, see
+# Cache; the distances are kept by index of the bitmaps of the map (see
+# grid.Bitmaps), whose border isn't walkable.
+
+import collections, heapq
+
+# flee maps: the distances to the target times -FLEE, smoothed, so that a
+# cornered creature may go past the target towards a farther way out
+FLEE = 1.2
+
+class Field:
+    def __init__(self, target, bitmaps, radius, revision=None):
+        self.target = target
+        self.bitmaps = bitmaps
+        self.radius = radius
+        self.revision = revision
+        width = bitmaps.width
+        self.steps = (-width, 1, width, -1)
+        # index -> steps to the target, cells farther than radius left out
+        self.distances = {}
+        self.flee_distances = None
+        start = bitmaps.index(target)
+        if start == None or not bitmaps.inside(target):
+            return
+        walkable = bitmaps.walkable
+        distances = self.distances
+        distances[start] = 0
+        border = [start]
+        for distance in range(1, radius+1):
+            next_border = []
+            for current in border:
+                for step in self.steps:
+                    next = current + step
+                    if walkable[next] and next not in distances:
+                        distances[next] = distance
+                        next_border.append(next)
+            if not next_border:
+                break
+            border = next_border
+    def __contains__(self, pos):
+        return self.bitmaps.index(pos) in self.distances
+    def __iter__(self):
+        # the cells of the field
+        return (self.bitmaps.pos(index) for index in self.distances)
+    def distance(self, pos):
+        # steps from pos to the target, None out of the field
+        return self.distances.get(self.bitmaps.index(pos))
+    def downhill(self, distances, pos):
+        # the neighbours of pos lower than it, lowest first
+        index = self.bitmaps.index(pos)
+        if index not in distances:
+            return []
+        lower = [(distances[index+step], index+step) for step in self.steps if distances.get(index+step, distances[index]) < distances[index]]
+        lower.sort()
+        return [self.bitmaps.pos(index) for distance, index in lower]
+    def towards(self, pos):
+        # the neighbours of pos getting closer to the target, best first
+        return self.downhill(self.distances, pos)
+    def flee(self):
+        # the flee map, computed on first use: each cell is then at most one
+        # more than its lowest neighbour
+        if self.flee_distances == None:
+            flee = {index: -FLEE*distance for index, distance in self.distances.items()}
+            border = [(value, index) for index, value in flee.items()]
+            heapq.heapify(border)
+            while border:
+                value, current = heapq.heappop(border)
+                if value > flee[current]:
+                    continue
+                for step in self.steps:
+                    next = current + step
+                    if next in flee and value + 1 < flee[next]:
+                        flee[next] = value + 1
+                        heapq.heappush(border, (value + 1, next))
+            self.flee_distances = flee
+        return self.flee_distances
+    def away(self, pos):
+        # the neighbours of pos to flee the target by, best first
+        return self.downhill(self.flee(), pos)
+
+class Cache:
+    # least recently used fields by (target, radius, revision of the map):
+    # the chasers of a target share its field until it moves
+    SIZE = 16
+    def __init__(self, size=None):
+        self.size = self.SIZE if size == None else size
+        self.fields = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def clear(self):
+        self.fields.clear()
+    def get(self, target, radius, revision):
+        # the field, or None (counted as a miss)
+        key = (target, radius, revision)
+        if key in self.fields:
+            self.hits += 1
+            self.fields.move_to_end(key)
+            return self.fields[key]
+        self.misses += 1
+        return None
+    def add(self, field):
+        self.fields[field.target, field.radius, field.revision] = field
+        if len(self.fields) > self.size:
+            self.fields.popitem(last=False)
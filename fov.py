@@ -0,0 +1,322 @@
+### FOV module
+# Field of view by symmetric shadowcasting, with integers only.
+# Each quadrant (north, east, south, west) is scanned row by row going away
+# from the origin; a row is the part of a line of cells between two slopes,
+# obscure cells narrowing the slopes of the rows behind them.
+# A slope is kept as a fraction (numerator, denominator), denominator > 0.
+#
+# A cell is seen if its center is between the slopes of its row, obscure
+# cells being seen as soon as a part of them is, so that the result is
+# symmetric: if a sees b, b sees a.
+# Cells without tile are never seen and block the light, so that the scan
+# stays within the map whatever the range.
+#
+# Many viewers at once (the monsters...) use lines of sight instead, see
+# visibility_matrix and visibility_bitsets.
+
+import collections, heapq
+import grid
+
+try:
+    import numpy
+except ImportError:
+    # the batches are computed in pure Python then
+    numpy = None
+
+# (row, col) -> (dy, dx) of each quadrant
+QUADRANTS = (
+    lambda row, col: (-row, col),
+    lambda row, col: (col, row),
+    lambda row, col: (row, col),
+    lambda row, col: (col, -row)
+)
+
+def scan(origin, bitmaps, max_range, transform):
+    # set of the cells seen from origin in the quadrant of `transform', up to
+    # an euclidian distance of max_range, reading the opacity of the cells
+    # from a grid.Bitmaps
+    if not bitmaps.inside(origin):
+        return set()
+    opacity = bitmaps.opacity
+    width = bitmaps.width
+    center = bitmaps.index(origin)
+    # index steps of a row and of a column
+    dy, dx = transform(1, 0)
+    row_step = dy*width + dx
+    dy, dx = transform(0, 1)
+    col_step = dy*width + dx
+    seen = set()
+    square_range = max_range * max_range
+    # rows still to scan: (depth, start slope, end slope); the slopes stay
+    # between -1 and 1, so that the cells read are the neighboors of
+    # transparent ones, inside of the bitmaps
+    rows = [(1, -1, 1, 1, 1)]
+    while rows:
+        depth, start_num, start_den, end_num, end_den = rows.pop()
+        if depth > max_range:
+            continue
+        # columns whose centre is between the slopes, rounding ties up for
+        # the first one, down for the last one
+        first = (2*depth*start_num + start_den) // (2*start_den)
+        last = -((end_den - 2*depth*end_num) // (2*end_den))
+        row = center + depth*row_step
+        square_depth = depth*depth
+        previous = None
+        for col in range(first, last+1):
+            index = row + col*col_step
+            cell = opacity[index]
+            obscure = cell != grid.TRANSPARENT
+            if cell != grid.NO_CELL and square_depth + col*col <= square_range:
+                if obscure or (col*start_den >= depth*start_num and col*end_den <= depth*end_num):
+                    seen.add(index)
+            if previous == True and not obscure:
+                # leaving obscure cells: the row starts further
+                start_num, start_den = 2*col - 1, 2*depth
+            if previous == False and obscure:
+                # entering obscure cells: the next row ends before them
+                rows.append((depth+1, start_num, start_den, 2*col - 1, 2*depth))
+            previous = obscure
+        if previous == False:
+            rows.append((depth+1, start_num, start_den, end_num, end_den))
+    return {bitmaps.pos(index) for index in seen}
+
+def compute(origin, bitmaps, max_range):
+    # set of the cells seen from origin
+    seen = {origin}
+    for transform in QUADRANTS:
+        seen |= scan(origin, bitmaps, max_range, transform)
+    return seen
+
+def quadrants(origin, pos, max_range):
+    # indexes in QUADRANTS of the quadrants whose scan reads pos
+    dy, dx = pos[0]-origin[0], pos[1]-origin[1]
+    if max(abs(dy), abs(dx)) > max_range:
+        return []
+    if (dy, dx) == (0, 0):
+        return list(range(len(QUADRANTS)))
+    return [i for i, inside in enumerate((-dy >= abs(dx), dx >= abs(dy), dy >= abs(dx), -dx >= abs(dy))) if inside]
+
+class Field:
+    # field of view kept by quadrant, so that when a cell changes only the
+    # quadrants holding it are scanned again
+    def __init__(self, origin, bitmaps, max_range, scans=None):
+        # bitmaps: function returning the grid.Bitmaps of the map
+        self.origin = origin
+        self.bitmaps = bitmaps
+        self.max_range = max_range
+        self.scans = [scan(origin, bitmaps(), max_range, transform) for transform in QUADRANTS] if scans == None else scans
+        self.cells = frozenset({origin}.union(*self.scans))
+        # revision of the map the field was computed for
+        self.revision = None
+    def copy(self):
+        field = Field(self.origin, self.bitmaps, self.max_range, list(self.scans))
+        field.revision = self.revision
+        return field
+    def update(self, pos):
+        # scans again what the opacity of pos can change; returns the cells
+        # newly seen and the ones no longer seen
+        changed = quadrants(self.origin, pos, self.max_range)
+        if not changed:
+            return set(), set()
+        before = set().union(*(self.scans[i] for i in changed))
+        bitmaps = self.bitmaps()
+        for i in changed:
+            self.scans[i] = scan(self.origin, bitmaps, self.max_range, QUADRANTS[i])
+        after = set().union(*(self.scans[i] for i in changed))
+        # cells on the diagonals are in two quadrants
+        others = [self.scans[i] for i in range(len(QUADRANTS)) if i not in changed]
+        lit = {cell for cell in after - before if not any(cell in cells for cells in others)}
+        dark = {cell for cell in before - after if cell != self.origin and not any(cell in cells for cells in others)}
+        self.cells = self.cells.union(lit).difference(dark)
+        return lit, dark
+
+class Cache:
+    # least recently used fields of view, by (origin, range, revision of the
+    # map): the same field isn't computed again while walking back and forth
+    SIZE = 64
+    def __init__(self, size=None):
+        self.size = self.SIZE if size == None else size
+        self.fields = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def clear(self):
+        self.fields.clear()
+    def get(self, origin, max_range, revision):
+        # the field, or None (counted as a miss)
+        key = (origin, max_range, revision)
+        if key in self.fields:
+            self.hits += 1
+            self.fields.move_to_end(key)
+            return self.fields[key]
+        self.misses += 1
+        return None
+    def add(self, field):
+        self.fields[field.origin, field.max_range, field.revision] = field
+        if len(self.fields) > self.size:
+            self.fields.popitem(last=False)
+
+# cells around (0, 0) in the order of walk, and the index in OFFSETS of the
+# end of each ring (cells at the same chebyshev distance)
+OFFSETS = []
+RING_ENDS = []
+
+def ring_offsets(radius):
+    # OFFSETS, computed up to the ring `radius' at least; the cells are
+    # visited by chebyshev distance, the lowest cell first among the ones
+    # reached by a step up, right, down or left from the cells visited
+    global OFFSETS, RING_ENDS
+    if radius < len(RING_ENDS):
+        return OFFSETS
+    radius = max(radius, 2*len(RING_ENDS))
+    offsets = []
+    ends = []
+    border = [(0, (0, 0))]
+    visited = {(0, 0)}
+    while border:
+        ring, (y, x) = heapq.heappop(border)
+        if ring == len(ends) + 1:
+            ends.append(len(offsets))
+        offsets.append((y, x))
+        for next in ((y-1, x), (y, x+1), (y+1, x), (y, x-1)):
+            distance = max(abs(next[0]), abs(next[1]))
+            if distance <= radius and next not in visited:
+                visited.add(next)
+                heapq.heappush(border, (distance, next))
+    ends.append(len(offsets))
+    OFFSETS, RING_ENDS = offsets, ends
+    return OFFSETS
+
+def walk(start, radius=None):
+    # the cells by chebyshev distance from start, up to radius (without
+    # end if None), from the precomputed OFFSETS
+    y, x = start
+    ring = 0
+    while radius == None or ring <= radius:
+        offsets = ring_offsets(ring if radius == None else radius)
+        begin = RING_ENDS[ring-1] if ring else 0
+        ring = len(RING_ENDS)-1 if radius == None else radius
+        for dy, dx in offsets[begin:RING_ENDS[ring]]:
+            yield y+dy, x+dx
+        ring += 1
+
+def line(a, b):
+    # cells strictly between a and b on the line from a to b, one step on
+    # the longest axis at a time, rounding halves up on the other one: the
+    # line from b to a is the same one, reversed
+    dy, dx = b[0]-a[0], b[1]-a[1]
+    n = max(abs(dy), abs(dx))
+    return [(a[0] + (2*k*dy + n) // (2*n), a[1] + (2*k*dx + n) // (2*n)) for k in range(1, n)]
+
+def sees(bitmaps, a, b, max_range):
+    # whether b has a tile, is in range of a and every cell of the line
+    # between them is transparent
+    if not (bitmaps.inside(a) and bitmaps.inside(b)):
+        return False
+    if (b[0]-a[0])**2 + (b[1]-a[1])**2 > max_range*max_range:
+        return False
+    opacity = bitmaps.opacity
+    if opacity[bitmaps.index(b)] == grid.NO_CELL:
+        return False
+    return all(opacity[bitmaps.index(cell)] == grid.TRANSPARENT for cell in line(a, b))
+
+class LineCache:
+    # blockers of the lines of sight, for a revision of the map: the first
+    # and the last cell of the line from the lowest end to the other one
+    # which aren't transparent (None, None if there isn't any), so that a
+    # line and its reverse are computed once
+    SIZE = 16384
+    def __init__(self, size=None):
+        self.size = self.SIZE if size == None else size
+        self.lines = {}
+        self.revision = None
+        self.hits = 0
+        self.misses = 0
+    def blockers(self, lowest, highest, revision, bitmaps):
+        # bitmaps: function returning the grid.Bitmaps of the map
+        if revision != self.revision or len(self.lines) >= self.size:
+            self.lines.clear()
+            self.revision = revision
+        key = (lowest, highest)
+        if key in self.lines:
+            self.hits += 1
+            return self.lines[key]
+        self.misses += 1
+        bitmaps = bitmaps()
+        if bitmaps.inside(lowest) and bitmaps.inside(highest):
+            # the whole line is inside of the bitmaps, see line
+            opacity, width = bitmaps.opacity, bitmaps.width
+            y, x = lowest[0] - bitmaps.y0, lowest[1] - bitmaps.x0
+            dy, dx = highest[0]-lowest[0], highest[1]-lowest[1]
+            n = max(abs(dy), abs(dx))
+            def blocks(k):
+                return opacity[(y + (2*k*dy + n) // (2*n))*width + x + (2*k*dx + n) // (2*n)] != grid.TRANSPARENT
+            first = next((k for k in range(1, n) if blocks(k)), None)
+            if first == None:
+                blockers = None, None
+            else:
+                last = next(k for k in range(n-1, 0, -1) if blocks(k))
+                blockers = tuple((lowest[0] + (2*k*dy + n) // (2*n), lowest[1] + (2*k*dx + n) // (2*n)) for k in (first, last))
+        else:
+            def blocks(cell):
+                index = bitmaps.index(cell)
+                return index == None or bitmaps.opacity[index] != grid.TRANSPARENT
+            cells = line(lowest, highest)
+            first = next((cell for cell in cells if blocks(cell)), None)
+            blockers = first, first if first == None else next(cell for cell in reversed(cells) if blocks(cell))
+        self.lines[key] = blockers
+        return blockers
+    def first_blocker(self, a, b, revision, bitmaps):
+        # first cell blocking the sight on the line from a to b, both
+        # excluded, None if there isn't any
+        if a <= b:
+            return self.blockers(a, b, revision, bitmaps)[0]
+        return self.blockers(b, a, revision, bitmaps)[1]
+
+def visibility_matrix(bitmaps, viewers, targets, max_range):
+    # numpy array of booleans, [i, j] being sees(bitmaps, viewers[i],
+    # targets[j], max_range); the lines of the pairs in range are followed
+    # all at once, one step at a time. Needs numpy.
+    opacity = numpy.frombuffer(bitmaps.opacity, dtype=numpy.uint8)
+    viewers = numpy.array(viewers, dtype=numpy.int64).reshape(-1, 2) - (bitmaps.y0, bitmaps.x0)
+    targets = numpy.array(targets, dtype=numpy.int64).reshape(-1, 2) - (bitmaps.y0, bitmaps.x0)
+    def inside(cells):
+        return (cells[:, 0] > 0) & (cells[:, 0] < bitmaps.height-1) & (cells[:, 1] > 0) & (cells[:, 1] < bitmaps.width-1)
+    # the targets having a tile
+    present = inside(targets)
+    present[present] = opacity[targets[present, 0]*bitmaps.width + targets[present, 1]] != grid.NO_CELL
+    dy = targets[None, :, 0] - viewers[:, 0, None]
+    dx = targets[None, :, 1] - viewers[:, 1, None]
+    seen = (dy*dy + dx*dx <= max_range*max_range) & inside(viewers)[:, None] & present[None, :]
+    # the pairs whose line is still followed
+    i, j = numpy.nonzero(seen)
+    vy, vx = viewers[i, 0], viewers[i, 1]
+    dy, dx = dy[i, j], dx[i, j]
+    n = numpy.maximum(numpy.abs(dy), numpy.abs(dx))
+    k = 1
+    while len(i):
+        going = k < n
+        i, j, vy, vx, dy, dx, n = i[going], j[going], vy[going], vx[going], dy[going], dx[going], n[going]
+        cells = (vy + (2*k*dy + n) // (2*n))*bitmaps.width + vx + (2*k*dx + n) // (2*n)
+        blocked = opacity[cells] != grid.TRANSPARENT
+        seen[i[blocked], j[blocked]] = False
+        going = ~blocked
+        i, j, vy, vx, dy, dx, n = i[going], j[going], vy[going], vx[going], dy[going], dx[going], n[going]
+        k += 1
+    return seen
+
+def visibility_bitsets(bitmaps, viewers, targets, max_range, use_numpy=True):
+    # one int per viewer, whose bit j is set if it sees targets[j], see
+    # visibility_matrix; in pure Python without numpy
+    if numpy != None and use_numpy:
+        if not len(viewers) or not len(targets):
+            return [0] * len(viewers)
+        packed = numpy.packbits(visibility_matrix(bitmaps, viewers, targets, max_range), axis=1, bitorder="little")
+        return [int.from_bytes(row.tobytes(), "little") for row in packed]
+    bitsets = []
+    for viewer in viewers:
+        bits = 0
+        for j, target in enumerate(targets):
+            if sees(bitmaps, viewer, target, max_range):
+                bits |= 1 << j
+        bitsets.append(bits)
+    return bitsets
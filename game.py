@@ -1,4 +1,4 @@
-import state, curses, random, heapq, functools, creature, queue, time
+import state, curses, random, heapq, functools, creature, time
 from math import pi, atan, atan2
 class ActionsQueue:
     def __init__(self, queue=None):
@@ -44,25 +44,6 @@ class UUIDGen:
         self.taken.add(self.current)
         return self.current
 
-class FOVWalkGen:
-    def __init__(self, start):
-        self.start = start
-        self.visited = {start}
-        self.border = queue.PriorityQueue()
-        self.border.put_nowait((0,start))
-        self.nb = 0
-    def neighboors(self, pos):
-        for dir in {state.UP, state.RIGHT, state.DOWN, state.LEFT}:
-            yield state.add_tuples(dir, pos)
-    def __next__(self):
-        distance, current = self.border.get_nowait()
-        self.nb += 1
-        for next in self.neighboors(current):
-            if next not in self.visited:
-                self.visited.add(next)
-                self.border.put_nowait((state.diag_distance(next, self.start),next))
-        return current
-
 class Shadow:
     def __init__(self, left, right):
         self.left = left
@@ -158,7 +139,12 @@ class GameFrame(state.Frame):
     def _post_init(self):
         self.auto_open = True
         self.window.map = state.map.Map()
+        self.levels = state.levels.LevelManager()
         self.creatures = {}
+        # positions of the creatures, for proximity queries
+        self.creature_index = state.spatial.SpatialIndex()
+        # stats of the creatures as arrays, see use_component_store
+        self.component_store = None
         self.items = {}
         state.keyhandler.add_handler(state.PRIORITIES["Game"])(self.get_key)
         self.actions = ActionsQueue()
@@ -182,6 +168,9 @@ class GameFrame(state.Frame):
     def pre_load(self):
         self.window.map.reset()
         self.creatures = {}
+        self.creature_index.clear()
+        if self.component_store != None:
+            self.component_store.clear()
         self.items = {}
     def load_creatures(self, creatures):
         self.creature_uuid_gen = UUIDGen({creature.uuid for creature in creatures})
@@ -189,16 +178,25 @@ class GameFrame(state.Frame):
             if creature.is_hero:
                 self.hero_uuid = creature.uuid
             self.creatures[creature.uuid] = creature
+            self.creature_index.add(creature.uuid, creature.pos)
+            if self.component_store != None:
+                self.component_store.bind(creature)
             self.window.map[creature.pos].add_creature(creature.uuid)
             self.actions.add_action(creature.speed, creature.take_turn, creature.uuid)
     def remove_creatures_pos(self, pos):
         for uuid in self.window.map[pos].creatures:
+            if self.component_store != None:
+                self.component_store.unbind(self.creatures[uuid])
             del self.creatures[uuid]
-        self.window.map[pos].creatures.clear()
+            self.creature_index.remove(uuid)
+        self.window.map.clear_creatures(pos)
     def remove_creature(self, uuid):
         entity = self.get_creature(uuid)
-        self.window.map[entity.pos].creatures.remove(entity.uuid)
+        self.window.map[entity.pos].remove_creature(entity.uuid)
         del self.creatures[uuid]
+        self.creature_index.remove(uuid)
+        if self.component_store != None:
+            self.component_store.unbind(entity)
     def load_items(self, items):
         self.items_uuid_gen = UUIDGen({item.uuid for item in items})
         for item in items:
@@ -210,6 +208,9 @@ class GameFrame(state.Frame):
         creature.uuid = next(self.creature_uuid_gen)
         tile.add_creature(creature.uuid)
         self.creatures[creature.uuid] = creature
+        self.creature_index.add(creature.uuid, creature.pos)
+        if self.component_store != None:
+            self.component_store.bind(creature)
         self.actions.add_action(creature.speed, creature.take_turn, creature.uuid)
     def init_actions_with_creatures(self):
         for creature in self.creatures.values():
@@ -219,11 +220,56 @@ class GameFrame(state.Frame):
         action, parent = self.actions.pop_action()
         if parent not in self.creatures:
             return
-        actions = action()
+        if parent == self.hero_uuid:
+            # waits for the player's keys, which isn't timed
+            actions = action()
+        else:
+            actions = self.creature_turn(action)
         for time, act in actions:
             self.actions.add_action(time, act, parent)
+    @state.metrics.timed("take_turn")
+    def creature_turn(self, action):
+        # the turn of a creature other than the hero
+        return action()
     def is_walkable(self, pos):
-        return not self.window.map[pos].wall and all(self.get_creature(uuid).is_walkable for uuid in self.window.map[pos].creatures)
+        return self.window.map.walkable(pos) and all(self.get_creature(uuid).is_walkable for uuid in self.window.map.grid.creatures.get(pos, ()))
+    def creatures_in_radius(self, pos, radius):
+        return [self.creatures[uuid] for uuid in self.creature_index.radius(pos, radius)]
+    def creatures_in_rect(self, y0, x0, y1, x1):
+        return [self.creatures[uuid] for uuid in self.creature_index.rect(y0, x0, y1, x1)]
+    def nearest_creatures(self, pos, k=1, exclude=()):
+        return [self.creatures[uuid] for uuid in self.creature_index.nearest(pos, k, exclude)]
+    def creatures_seeing(self, pos, radius):
+        # creatures having pos in sight, up to radius, see fov.sees
+        creatures = [creature for creature in self.creatures_in_radius(pos, radius) if creature.pos != pos]
+        bitsets = state.fov.visibility_bitsets(self.window.map.bitmaps(), [creature.pos for creature in creatures], [pos], radius)
+        return [creature for creature, bits in zip(creatures, bitsets) if bits]
+    def use_component_store(self):
+        # keeps the stats of the creatures in a components.ComponentStore
+        if self.component_store == None:
+            self.component_store = state.components.ComponentStore()
+            for creature in self.creatures.values():
+                self.component_store.bind(creature)
+    def area_damage(self, pos, radius, damage, source=-1):
+        # hurts every creature around pos
+        if self.component_store == None:
+            for creature in self.creatures_in_radius(pos, radius):
+                creature.hurt(damage, source)
+            return
+        # the damages computed in a single pass over the stats, then taken as
+        # Creature.hurt does
+        store = self.component_store
+        slots = store.in_radius(pos, radius)
+        for slot, realdamage in zip(slots, store.realdamage(slots, damage)):
+            creature = store.creatures[slot]
+            creature.react_to_attack(damage, source)
+            creature.take_damage(realdamage)
+    def regenerate(self, amount):
+        if self.component_store == None:
+            for creature in self.creatures.values():
+                creature.life = min(creature.life + amount, creature.max_life)
+        else:
+            self.component_store.regenerate(amount)
     def get_hero(self):
         return self.get_creature(self.hero_uuid)
     def player_action(self):
@@ -354,12 +400,54 @@ class GameFrame(state.Frame):
             state.action_frame.load_action(
                 state.action.neighboors_action
             )
+        elif key == ord(">"):
+            state.action_frame.load_action(
+                state.action.descend_action
+            )
+        elif key == ord("<"):
+            state.action_frame.load_action(
+                state.action.ascend_action
+            )
+        elif key == ord("m"):
+            state.action_frame.load_action(
+                state.action.metrics_action
+            )
+        elif key == ord("M"):
+            state.action_frame.load_action(
+                state.action.export_metrics_action
+            )
         else:
             return False
         return True
     def load_map(self):
         self.window.map.load_file(state.realpath("maps/map2.mp"))
         #self.window.map.load_custom()
+        self.levels.start(self.window.map)
+    def change_level(self, step):
+        # the hero goes `step' levels down, its level being kept as it is
+        depth = self.levels.depth + step
+        if depth < 0:
+            state.output("There is no level above.")
+            return
+        hero = self.get_hero()
+        self.levels.leave(self.window.map, self.creatures, self.items, hero)
+        level = self.levels.enter(depth)
+        self.window.map = level.map
+        self.pre_load()
+        # the actions of the creatures left behind are dropped, the hero's
+        # turn being queued again once this one is over
+        self.actions = ActionsQueue()
+        self.load_creatures([state.creature.creature_map[c["creature_id"]](**c) for c in level.objs["creatures"]])
+        self.load_items([state.items.item_map[item["item_id"]](**item) for item in level.objs["items"]])
+        hero.pos = level.entry
+        self.creature_uuid_gen.taken.add(hero.uuid)
+        self.creatures[hero.uuid] = hero
+        self.creature_index.add(hero.uuid, hero.pos)
+        if self.component_store != None:
+            self.component_store.bind(hero)
+        self.window.map[hero.pos].add_creature(hero.uuid)
+        self.window.has_moved = True
+        state.output("Level %s" % depth)
     def move(self, what, dir):
         if self.could_be_open(state.add_tuples(self.creatures[what].pos, dir)) and self.auto_open:
             self.open(state.add_tuples(self.creatures[what].pos, dir))
@@ -373,16 +461,27 @@ class GameFrame(state.Frame):
     def could_be_open(self, pos):
         return self.window.map[pos] and self.window.map[pos].openable and self.window.map[pos].wall
     def open(self, pos):
-        self.window.map[pos].wall = False
-        self.window.map[pos].obscure = False
+        self.window.map.set_state(pos, False)
         state.output("%s opened!" % self.window.map[pos].desc.capitalize())
 
 class GameWindow(state.Window):
     OFFSET = 10
+    # field of view algorithm: "shadowcasting" (see fov) or "walk", the
+    # shadows walk of walk_visibility
+    FOV = "shadowcasting"
+    # steps from their target within which creatures follow its flow.Field
+    FLOW_RADIUS = 30
     def _post_init(self):
         self.offset = (20,20)
         self.hide = False
         self.has_moved = True
+        self.fov_cache = state.fov.Cache()
+        # (grid, field of view) lit on the map, see update_seen
+        self.seen = None
+        self.line_cache = state.fov.LineCache()
+        self.flow_cache = state.flow.Cache()
+        # drawn over the game window when shown, see action.toggle_metrics
+        self.metrics_window = MetricsWindow(self.parent, self.y, self.x, min(self.height, 24), min(self.width, 62))
     def pos_to_realpos(self, pos):
         return state.sub_tuples(pos, self.offset)
     def add_highlight(self, pos):
@@ -449,15 +548,76 @@ class GameWindow(state.Window):
         angle2 = Angle(*self.transform_coords(state.sub_tuples(vertex2, pos1center)))
         return Shadow(angle1, angle2)
     def compute_visibility(self, start, max_range=float("inf")):
-        t = time.time()
-        gen = FOVWalkGen(start)
+        if self.FOV == "walk":
+            return self.walk_visibility(start, max_range)
+        return self.visibility_field(start, max_range).cells
+    def los(self, a, b):
+        # whether nothing blocks the sight between a and b
+        return self.first_blocker(a, b) == None
+    def first_blocker(self, a, b):
+        # first cell blocking the sight on the line from a to b, see fov.line
+        return self.line_cache.first_blocker(a, b, self.map.revision, self.map.bitmaps)
+    def visibility_field(self, start, max_range):
+        # the fov.Field from start, updated from the one lit on the map when
+        # only a few cells changed since
+        revision = self.map.revision
+        field = self.fov_cache.get(start, max_range, revision)
+        if field == None:
+            state.metrics.count("fov.cache.misses")
+            updated = self.updated_field(start, max_range)
+            if updated == None:
+                field = state.fov.Field(start, self.map.bitmaps, max_range)
+                field.revision = revision
+                self.fov_cache.add(field)
+            else:
+                field = updated[0]
+        else:
+            state.metrics.count("fov.cache.hits")
+        return field
+    def updated_field(self, start, max_range):
+        # the field lit on the map (see update_seen) updated with the cells
+        # changed since, and the cells whose visibility changed; None if it
+        # isn't the one from start or the changes aren't known
+        if self.seen == None or self.seen[0] is not self.map.grid or (self.seen[1].origin, self.seen[1].max_range) != (start, max_range):
+            return None
+        changes = self.map.grid.changes_since(self.seen[1].revision)
+        if changes == None:
+            return None
+        if not changes:
+            return self.seen[1], set()
+        state.metrics.count("fov.incremental")
+        field = self.seen[1].copy()
+        changed = set()
+        for pos in changes:
+            lit, dark = field.update(pos)
+            changed.update(lit, dark)
+        field.revision = self.map.revision
+        self.fov_cache.add(field)
+        return field, changed
+    def flow_field(self, target, radius=None):
+        # the flow.Field to target, shared by every creature going there
+        if radius == None:
+            radius = self.FLOW_RADIUS
+        revision = self.map.revision
+        field = self.flow_cache.get(target, radius, revision)
+        if field == None:
+            state.metrics.count("flow.cache.misses")
+            field = state.flow.Field(target, self.map.bitmaps(), radius, revision)
+            self.flow_cache.add(field)
+        else:
+            state.metrics.count("flow.cache.hits")
+        return field
+    def walk_visibility(self, start, max_range=float("inf")):
+        t = time.perf_counter()
         shadows = []
         steps = 0
         lits = set()
         shadow_time = 0
-        while not (len(shadows) == 1 and shadows[0].is_full_circle()):
+        # the first ring out of range is the last one looked at
+        for pos in state.fov.walk(start, None if max_range == float("inf") else int(max_range)+1):
+            if len(shadows) == 1 and shadows[0].is_full_circle():
+                break
             steps += 1
-            pos = next(gen)
             y, x = state.add_tuples(pos, self.offset)
             if not (1 <= y < self.height-1 and 1 <= x < self.width-2):
                 continue
@@ -465,9 +625,9 @@ class GameWindow(state.Window):
                 break
             if not self.map[pos]:
                 continue
-            t1 = time.time()
+            t1 = time.perf_counter()
             shadow = self.compute_shadow(start, pos)
-            t2 = time.time()
+            t2 = time.perf_counter()
             shadow_time += t2-t1
             if any(s.strictly_contains(shadow) for s in shadows):
                 continue
@@ -489,24 +649,54 @@ class GameWindow(state.Window):
                 else:
                     i += 1
             shadows.append(shadow)
-        total_time = time.time() - t
-        message = """Total rendering time for {steps} steps: {total}ms ({mean}us/step)
- - Shadow: {shadow}ms ({mean_shadow}us/step)""".format(total=int(total_time*1000), steps=steps, shadow=int(shadow_time*1000), mean=int(total_time*1000000/steps), mean_shadow=int(shadow_time/steps*10**6))
-        #state.output(message)
+        state.metrics.sample("fov.walk", (time.perf_counter() - t)*1000)
+        state.metrics.sample("fov.walk.shadows", shadow_time*1000)
+        state.metrics.count("fov.walk.steps", steps)
         return lits
+    @state.metrics.timed("fov")
     def update_seen(self):
+        # with shadowcasting, when the hero didn't move, only the cells whose
+        # visibility changed since the last field lit (as fov.Field.update
+        # tells) are updated; the map is lit again otherwise
+        pos = state.game_frame.get_hero().pos
+        if self.FOV == "walk":
+            self.seen = None
+            self.light(self.compute_visibility(pos, max_range=20))
+            return
+        updated = self.updated_field(pos, 20)
+        if updated == None:
+            field = self.visibility_field(pos, 20)
+            self.light(field.cells)
+        else:
+            field, changed = updated
+            lit = self.seen[1].cells
+            for cell in changed:
+                if (cell in field.cells) == (cell in lit):
+                    # changed back by a later cell
+                    continue
+                if cell in field.cells:
+                    self.map[cell].lit = 2
+                    self.map[cell].known = True
+                else:
+                    # still known
+                    self.map[cell].lit = 1
+        self.seen = (self.map.grid, field)
+    def light(self, cells):
+        # lights `cells', the other known cells being dark
         self.map.unlit()
-        for pos in self.compute_visibility(state.game_frame.get_hero().pos, max_range=20):
+        for pos in cells:
             self.map[pos].lit = 2
             self.map[pos].known = True
         self.map.lit_known()
+    @state.metrics.timed("draw_map")
     def draw_map(self):
         for y in range(1, self.height-1):
             for x in range(1, self.width-2):
                 # real x and y
                 ry, rx = state.sub_tuples((y, x), self.offset)
-                if self.map[ry, rx]:
-                    self.addch(y, x, self.map[ry, rx].draw())
+                cell = self.map.draw_cell((ry, rx))
+                if cell != None:
+                    self.addch(y, x, cell)
     def in_rect(self, y, x):
         return 1 <= y < self.height-1 and 1 <= x < self.width-2
     def regulate_offset(self):
@@ -518,3 +708,12 @@ class GameWindow(state.Window):
             self.offset = state.add_tuples(self.offset, (0, 1))
         while state.game_frame.creatures[state.game_frame.hero_uuid].pos[1] + self.offset[1] >= self.width-(self.OFFSET+2):
             self.offset = state.add_tuples(self.offset, (0, -1))
+
+class MetricsWindow(state.Window):
+    # the metrics (see metrics), over the game window
+    def draw(self):
+        lines = state.metrics.lines()
+        for y in range(1, self.height-1):
+            line = lines[y-1] if y-1 < len(lines) else ""
+            self.addstr(y, 1, line[:self.width-3].ljust(self.width-3))
+        self.border()
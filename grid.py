@@ -0,0 +1,245 @@
+### Grid module
+# Chunked storage for the cells of a map: instead of one object per cell,
+# every chunk keeps the type id and the flags of its cells in flat arrays
+
+import array, collections, itertools
+
+# A chunk is a CHUNK_SIZE*CHUNK_SIZE square of cells
+CHUNK_SHIFT = 4
+CHUNK_SIZE = 1 << CHUNK_SHIFT
+CHUNK_MASK = CHUNK_SIZE - 1
+CHUNK_AREA = CHUNK_SIZE * CHUNK_SIZE
+
+# Cell flags
+#  PRESENT   - there is a tile in this cell
+#  WALL      - the tile isn't walkable
+#  OBSCURE   - the tile blocks the sight
+#  KNOWN     - the tile has already been seen
+#  HIGHLIGHT - the tile is highlighted by a prompt
+#  LIT       - two bits holding Tile.lit (0, 1 or 2)
+PRESENT = 1
+WALL = 2
+OBSCURE = 4
+KNOWN = 8
+HIGHLIGHT = 16
+LIT_SHIFT = 5
+LIT = 3 << LIT_SHIFT
+
+def clear_table(bits):
+    # translation table clearing `bits' in every byte
+    return bytes(i & ~bits for i in range(256))
+
+def lit_table():
+    # translation table turning "not lit" known tiles into "known" ones
+    return bytes(i | (1 << LIT_SHIFT) if i & KNOWN and not i & LIT else i for i in range(256))
+
+def set_lit_table(lit):
+    return bytes((i & ~LIT) | (lit << LIT_SHIFT) if i & PRESENT else i for i in range(256))
+
+# revisions of the grids, unique over every grid, see ChunkedGrid.touch
+REVISIONS = itertools.count()
+# changes kept by a grid, see ChunkedGrid.changes_since
+CHANGES = 16
+
+# bytes of the bitmaps, see Bitmaps
+TRANSPARENT = 0
+OPAQUE = 1
+NO_CELL = 2
+OPACITY = bytes(NO_CELL if not i & PRESENT else OPAQUE if i & OBSCURE else TRANSPARENT for i in range(256))
+WALKABLE = bytes(1 if i & PRESENT and not i & WALL else 0 for i in range(256))
+
+UNHIGHLIGHT = clear_table(HIGHLIGHT)
+UNLIT = clear_table(LIT)
+LIT_KNOWN = lit_table()
+LIT_ALL = set_lit_table(2)
+
+def chunk_key(pos):
+    return pos[0] >> CHUNK_SHIFT, pos[1] >> CHUNK_SHIFT
+
+def chunk_index(pos):
+    return ((pos[0] & CHUNK_MASK) << CHUNK_SHIFT) | (pos[1] & CHUNK_MASK)
+
+class Chunk:
+    __slots__ = ("ids", "flags", "count")
+    def __init__(self):
+        self.ids = array.array("H", bytes(2*CHUNK_AREA))
+        self.flags = bytearray(CHUNK_AREA)
+        self.count = 0
+
+class ChunkedGrid:
+    # lazy grids load their chunks on first access, see mapfile.MappedGrid
+    lazy = False
+    def __init__(self):
+        self.chunks = {}
+        # occupants are sparse, so they live outside of the chunks
+        self.creatures = {}
+        self.items = {}
+        self.size = 0
+        self.revision = next(REVISIONS)
+        # last changes: (previous revision, revision, changed cell)
+        self.changes = collections.deque(maxlen=CHANGES)
+    def touch(self, pos=None):
+        # to be called when the walls or the sight blockers change, so that
+        # what was computed from them (fields of view...) isn't used anymore;
+        # pos is the changed cell, if there is only one
+        revision = next(REVISIONS)
+        self.changes.append((self.revision, revision, pos))
+        self.revision = revision
+    def changes_since(self, revision):
+        # cells changed since `revision', None if they aren't known
+        if revision == self.revision:
+            return []
+        cells = None
+        for previous, current, pos in self.changes:
+            if previous == revision:
+                cells = []
+            if cells != None:
+                if pos == None:
+                    return None
+                cells.append(pos)
+        return cells
+    def chunk(self, key):
+        return self.chunks.get(key)
+    def locate(self, pos):
+        # returns (chunk, index), chunk being None outside of the grid
+        return self.chunk(chunk_key(pos)), chunk_index(pos)
+    def __contains__(self, pos):
+        chunk, index = self.locate(pos)
+        return chunk is not None and bool(chunk.flags[index] & PRESENT)
+    def __len__(self):
+        return self.size
+    def set(self, pos, type_id, flags):
+        key = chunk_key(pos)
+        chunk = self.chunk(key)
+        if chunk is None:
+            chunk = self.chunks[key] = Chunk()
+        index = chunk_index(pos)
+        if not chunk.flags[index] & PRESENT:
+            chunk.count += 1
+            self.size += 1
+        chunk.ids[index] = type_id
+        chunk.flags[index] = flags | PRESENT
+    def remove(self, pos):
+        chunk, index = self.locate(pos)
+        if chunk is None or not chunk.flags[index] & PRESENT:
+            return
+        chunk.flags[index] = 0
+        chunk.count -= 1
+        self.size -= 1
+        self.creatures.pop(pos, None)
+        self.items.pop(pos, None)
+        if chunk.count == 0:
+            del self.chunks[chunk_key(pos)]
+    def positions(self, chunks=None):
+        for (cy, cx), chunk in chunks or self.chunks.items():
+            y0, x0 = cy << CHUNK_SHIFT, cx << CHUNK_SHIFT
+            flags = chunk.flags
+            for index in range(CHUNK_AREA):
+                if flags[index] & PRESENT:
+                    yield y0 + (index >> CHUNK_SHIFT), x0 + (index & CHUNK_MASK)
+    def fill_bitmaps(self, bitmaps):
+        # copies the flags of the cells to bitmaps, see Bitmaps
+        for key, chunk in self.chunks.items():
+            bitmaps.fill_chunk(key, chunk.flags)
+    def translate(self, table):
+        # applies a translation table to the flags of every cell at once
+        for chunk in self.chunks.values():
+            chunk.flags = chunk.flags.translate(table)
+    def add_occupant(self, occupants, pos, value):
+        if pos in occupants:
+            occupants[pos].append(value)
+        else:
+            occupants[pos] = [value]
+    def remove_occupant(self, occupants, pos, value):
+        # raises ValueError, as list.remove
+        if pos not in occupants:
+            raise ValueError("%s not in %s" % (value, pos))
+        occupants[pos].remove(value)
+        if not occupants[pos]:
+            del occupants[pos]
+    def clear_occupants(self):
+        self.creatures.clear()
+        self.items.clear()
+    def bounds(self):
+        # (min y, min x, max y, max x) of the cells, None for an empty grid
+        if not self.size:
+            return None
+        cy0 = min(key[0] for key in self.chunks)
+        cx0 = min(key[1] for key in self.chunks)
+        cy1 = max(key[0] for key in self.chunks)
+        cx1 = max(key[1] for key in self.chunks)
+        # only the chunks on the edges matter
+        edges = [(key, chunk) for key, chunk in self.chunks.items() if key[0] in (cy0, cy1) or key[1] in (cx0, cx1)]
+        ys, xs = zip(*self.positions(edges))
+        return min(ys), min(xs), max(ys), max(xs)
+
+class Bitmaps:
+    # opacity and walkability of the cells of a grid, one byte per cell in
+    # flat bytearrays, so that they are read with an index instead of a cell
+    # object. The cell (y, x) is at (y-y0)*width + x-x0, the origin (y0, x0)
+    # being fixed: the bitmaps cover the chunks of the grid and a border of
+    # one cell, so that the neighboors of a cell of the grid have an index.
+    #  opacity  - TRANSPARENT, OPAQUE or NO_CELL (no tile, which blocks the
+    #             sight too)
+    #  walkable - 1 for the cells which can be walked on
+    # Both are exposed as read-only memoryviews.
+    def __init__(self, grid):
+        self.grid = grid
+        self.revision = grid.revision
+        bounds = grid.bounds()
+        if bounds == None:
+            cy0 = cx0 = 0
+            cy1 = cx1 = -1
+        else:
+            cy0, cx0 = chunk_key(bounds[:2])
+            cy1, cx1 = chunk_key(bounds[2:])
+        self.y0 = (cy0 << CHUNK_SHIFT) - 1
+        self.x0 = (cx0 << CHUNK_SHIFT) - 1
+        self.height = ((cy1-cy0+1) << CHUNK_SHIFT) + 2
+        self.width = ((cx1-cx0+1) << CHUNK_SHIFT) + 2
+        self.opacity_bytes = bytearray([NO_CELL]) * (self.height*self.width)
+        self.walkable_bytes = bytearray(self.height*self.width)
+        grid.fill_bitmaps(self)
+        self.opacity = memoryview(self.opacity_bytes).toreadonly()
+        self.walkable = memoryview(self.walkable_bytes).toreadonly()
+    def fill_chunk(self, key, flags):
+        # copies the flags of the chunk key, None for no chunk; chunks out of
+        # the bitmaps are left out
+        y, x = key[0] << CHUNK_SHIFT, key[1] << CHUNK_SHIFT
+        if not self.inside((y, x)):
+            return
+        if flags is None:
+            flags = bytes(CHUNK_AREA)
+        for row in range(0, CHUNK_AREA, CHUNK_SIZE):
+            self.fill_row((y, x), flags[row:row+CHUNK_SIZE])
+            y += 1
+    def fill_row(self, pos, flags, table=None):
+        # copies a row of flags starting at pos, translated first by table if
+        # any; the row is to be inside the bitmaps
+        if table != None:
+            flags = flags.translate(table)
+        start = self.index(pos)
+        self.opacity_bytes[start:start+len(flags)] = flags.translate(OPACITY)
+        self.walkable_bytes[start:start+len(flags)] = flags.translate(WALKABLE)
+    def index(self, pos):
+        # index of pos, None out of the bitmaps
+        y, x = pos[0] - self.y0, pos[1] - self.x0
+        if 0 <= y < self.height and 0 <= x < self.width:
+            return y*self.width + x
+        return None
+    def pos(self, index):
+        return self.y0 + index // self.width, self.x0 + index % self.width
+    def inside(self, pos):
+        # whether pos is in the bitmaps, border excluded
+        return 0 < pos[0] - self.y0 < self.height-1 and 0 < pos[1] - self.x0 < self.width-1
+    def update(self, pos):
+        # reads the cell pos from the grid again; returns False if it is out
+        # of the bitmaps, which are to be built again then
+        if not self.inside(pos):
+            return False
+        chunk, index = self.grid.locate(pos)
+        flags = 0 if chunk is None else chunk.flags[index]
+        index = self.index(pos)
+        self.opacity_bytes[index] = OPACITY[flags]
+        self.walkable_bytes[index] = WALKABLE[flags]
+        return True
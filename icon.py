@@ -1,15 +1,11 @@
-import os, state
-icons = {}
+import assets
+# loaded on first use
+icons = None
 def load_icons():
     global icons
-    icons = {}
-    pwd, _, files = next(os.walk(state.realpath('icons')))
-    for file in files:
-        if not file.endswith(".ico"):
-            continue
-        name = file[:-4]
-        with open(os.path.join(pwd, file)) as f:
-            icons[name] = f.read()
+    icons = assets.load("icons")
 
 def get_icon(icon):
+    if icons is None:
+        load_icons()
     return icons.get(icon, "�")
@@ -1,4 +1,4 @@
-import state, os, configparser
+import state, assets
 
 WEAPON_CHAR = ")"
 ITEMS_CHAR = "*"
@@ -24,16 +24,12 @@ class Effect:
     def __setattr__(self, key, value):
         self.modifiers[key] = value
 
+SLOTS = ("right", "left", "helmet", "armor", "shoes")
+
 class Inventory:
     def __init__(self, slots=None, inventory=None):
         if slots == None:
-            self.slots = {
-                "right": NoneItem(),
-                "left": NoneItem(),
-                "helmet": NoneItem(),
-                "armor": NoneItem(),
-                "shoes": NoneItem()
-            }
+            self.slots = dict.fromkeys(SLOTS, NONE_ITEM)
         else:
             self.slots = slots
         if inventory == None:
@@ -48,7 +44,7 @@ class Inventory:
     def load(cls, value):
         slots = value["slots"]
         if slots:
-            slots = {key: Item.load(value[0], **value[1]) if value[0] != None else NoneItem() for key, value in slots.items()}
+            slots = {key: Item.load(value[0], **value[1]) if value[0] != None else NONE_ITEM for key, value in slots.items()}
         inventory = value["inventory"]
         if inventory:
             inventory = [Item.load(value[0], **value[1]) for value in inventory]
@@ -62,24 +58,20 @@ class Inventory:
     def inventory_effects(self):
         pass
 
-items = {}
-    
+# loaded on first use
+items = None
+
 def load_items():
     global items
-    items = {}
-    pwd, _, files = next(os.walk(state.realpath('items')))
-    for file in files:
-        if not file.endswith(".it"):
-            continue
-        name = file[:-3]
-        item = configparser.ConfigParser()
-        item.read(os.path.join(pwd, file))
-        items[name] = it2item(item, name)
+    items = {name: it2item(item, name) for name, item in assets.load("items").items()}
 
 def get_item(name):
+    if items is None:
+        load_items()
     return items[name]
 
 def it2item(item, name):
+    # item: {section: {key: value}}
     default_values = {
         "entity": {
             "str": "item",
@@ -95,11 +87,11 @@ def it2item(item, name):
         }
     }
     
-    for section in item.sections():
+    for section, entries in item.items():
         if section not in default_values:
             state.warning("item %s is defining a custom section %s" % (name, section))
             default_values[section] = {}
-        for key, value in item[section].items():
+        for key, value in entries.items():
             if key not in default_values[section]:
                 state.warning("item %s is defining a custom entry %s.%s=%s" % (name, section, key, value))
             default_values[section][key] = value
@@ -171,3 +163,6 @@ class NoneItem(Item):
         self.item = None
     def __bool__(self):
         return False
+
+# every empty slot holds this one
+NONE_ITEM = NoneItem()
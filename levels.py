@@ -0,0 +1,128 @@
+### Levels module
+# The levels of a dungeon, by depth. The current level and its neighbours
+# stay in memory; the least recently visited others are evicted to compiled
+# maps (see mapfile) and read back when visited again.
+# The level below the current one is generated in the background, so going
+# down doesn't wait for the generator.
+
+import collections, concurrent.futures, os, shutil, tempfile
+import state, grid, mapfile
+
+# flags kept by an evicted level: what has been explored is kept too
+LEVEL_FLAGS = mapfile.SAVED_FLAGS | grid.KNOWN
+# attributes of a map kept aside while it is evicted, so that a level read
+# from a map file is saved to its journal as usual once visited again
+MAP_ATTRIBUTES = ("file", "is_custom", "saved", "saved_tiles", "changed_tiles", "journal_size")
+
+class Level:
+    # a level out of play: its map, the saves of its entities ({"creatures":
+    # [...], "items": [...]}) and where the hero enters it
+    def __init__(self, map, objs=None, entry=None):
+        self.map = map
+        self.objs = {"creatures": [], "items": []} if objs == None else objs
+        self.entry = entry
+
+class LevelManager:
+    # levels in memory, current one included
+    RESIDENT = 3
+    def __init__(self, ops=2, resident=None):
+        # ops: index in map.GENERATE_OPS of the generator of new levels
+        self.ops = ops
+        self.resident = self.RESIDENT if resident == None else resident
+        # depth -> Level, least recently visited first
+        self.levels = collections.OrderedDict()
+        # depth -> (file, entry, attributes of the map)
+        self.evicted = {}
+        # depth -> Future of the tiles of a level being generated
+        self.generating = {}
+        self.executor = None
+        self.directory = None
+        self.depth = 0
+    def start(self, map, depth=0):
+        # forgets every level, `map' becoming the level `depth'
+        self.clear()
+        self.depth = depth
+        self.levels[depth] = Level(map)
+        self.prefetch(depth+1)
+    def clear(self):
+        for future in self.generating.values():
+            future.cancel()
+        self.generating.clear()
+        self.levels.clear()
+        for file, entry, attributes in self.evicted.values():
+            if os.path.exists(file):
+                os.remove(file)
+        self.evicted.clear()
+    def close(self):
+        self.clear()
+        if self.executor != None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.directory != None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+    def generate(self):
+        ops = state.map.GENERATE_OPS[self.ops]
+        return ops["gen"](*ops["args"], **ops["kwargs"]).generate()
+    def prefetch(self, depth):
+        # starts generating the level `depth' if it doesn't exist yet
+        if depth in self.levels or depth in self.evicted or depth in self.generating:
+            return
+        if self.executor == None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.generating[depth] = self.executor.submit(self.generate)
+    def new_level(self, depth):
+        self.prefetch(depth)
+        # only blocks if the level isn't generated yet
+        tiles = self.generating.pop(depth).result()
+        m = state.map.Map()
+        m.is_custom = True
+        m.has_map = True
+        m.set_tiles(tiles)
+        return Level(m, entry=min(pos for pos, tile in tiles.items() if not tile.wall))
+    def get(self, depth):
+        if depth in self.levels:
+            self.levels.move_to_end(depth)
+        elif depth in self.evicted:
+            self.levels[depth] = self.restore(depth)
+        else:
+            self.levels[depth] = self.new_level(depth)
+        return self.levels[depth]
+    def leave(self, map, creatures, items, hero):
+        # keeps the state of the current level
+        level = self.levels[self.depth]
+        level.map = map
+        level.objs = {
+            "creatures": [creature.save() for creature in creatures.values() if creature is not hero],
+            "items": [item.save() for item in items.values()]
+        }
+        level.entry = hero.pos
+    def enter(self, depth):
+        self.depth = depth
+        level = self.get(depth)
+        self.evict()
+        self.prefetch(depth+1)
+        return level
+    def evict(self):
+        # least recently visited levels first, never the current one and its
+        # neighbours
+        for depth in list(self.levels):
+            if len(self.levels) <= self.resident:
+                break
+            if abs(depth - self.depth) > 1:
+                self.store(depth)
+    def store(self, depth):
+        level = self.levels.pop(depth)
+        if self.directory == None:
+            self.directory = tempfile.mkdtemp(prefix="bov-levels-")
+        file = os.path.join(self.directory, "%s%s" % (depth, mapfile.EXTENSION))
+        mapfile.write_grid(file, level.map.grid, level.objs, LEVEL_FLAGS)
+        self.evicted[depth] = (file, level.entry, {attr: getattr(level.map, attr) for attr in MAP_ATTRIBUTES})
+    def restore(self, depth):
+        file, entry, attributes = self.evicted.pop(depth)
+        m = state.map.Map()
+        m.has_map = True
+        for attr, value in attributes.items():
+            setattr(m, attr, value)
+        m.grid = mapfile.open_map(file, LEVEL_FLAGS)
+        return Level(m, m.grid.objs, entry)
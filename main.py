@@ -9,6 +9,7 @@ import curses.textpad
 
 import state
 from state import *
+from state import color, Hero, GameWindow, ActionWindow, InventoryWindow
 
 
 
@@ -137,6 +138,8 @@ def main(stdscr):
             state.game_frame.take_turn()
     except QuitGame:
         stop = True
+        state.game_frame.window.map.compact()
+        state.game_frame.levels.close()
     
     
 #os.environ.setdefault('ESCDELAY', '25')
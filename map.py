@@ -1,27 +1,70 @@
-import json, creature, state, random, math, os
+import json, creature, state, random, math, os, grid, mapfile, assets, savefile
 
-class Tile:
-    def __init__(self, rchar, char, wall, obscure=None, desc="tile", openable=False, replace_fam=None, family=None):
-        self.rchar = rchar
-        self.char = char
-        self.wall = wall
-        self.desc = desc
-        self.openable = openable
-        self.replace_fam = replace_fam
-        self.family = family
+class TileType:
+    # Immutable description shared by every tile of the same type (flyweight):
+    # equal types are interned, so each one has a small integer id,
+    # which is what a map stores for each cell
+    __slots__ = ("id", "rchar", "char", "wall", "obscure", "desc", "openable", "replace_fam", "family", "flags")
+    types = []
+    ids = {}
+    def __new__(cls, rchar, char, wall, obscure=None, desc="tile", openable=False, replace_fam=None, family=None):
         if obscure == None:
-            self.obscure = wall
-        else:
-            self.obscure = obscure
-        # lit
-        #  0 - not lit (invisible)
-        #  1 - known, but not lit (grey, doesn't show monsters)
-        #  2 - completly lit (black, shows everything)
-        self.lit = 2
-        self.creatures = []
-        self.items = []
-        self.highlight = False
-        self.known = False
+            obscure = wall
+        key = (rchar, char, wall, obscure, desc, openable, replace_fam, family)
+        if key in cls.ids:
+            return cls.types[cls.ids[key]]
+        self = object.__new__(cls)
+        init = object.__setattr__
+        init(self, "id", len(cls.types))
+        for attr, value in zip(cls.__slots__[1:], key):
+            init(self, attr, value)
+        # initial flags of a cell of that type
+        flags = grid.PRESENT | (2 << grid.LIT_SHIFT)
+        if wall:
+            flags |= grid.WALL
+        if obscure:
+            flags |= grid.OBSCURE
+        init(self, "flags", flags)
+        cls.ids[key] = self.id
+        cls.types.append(self)
+        return self
+    def __setattr__(self, attr, value):
+        raise AttributeError("TileType is immutable")
+    def __reduce__(self):
+        return TileType, tuple(getattr(self, attr) for attr in self.__slots__[1:-1])
+    def replace(self, **changes):
+        values = {attr: getattr(self, attr) for attr in self.__slots__[1:-1]}
+        values.update(changes)
+        return TileType(**values)
+    def __repr__(self):
+        return "TileType<%s,%r>" % (self.id, self.rchar)
+
+# Types used by the generators
+WALL_TILE = TileType("#", "#", True, desc="wall")
+GROUND_TILE = TileType(".", "·", False, desc="inside ground")
+DOOR_TILE = TileType("+", "+", True, desc="door", openable=True)
+
+def type_property(attr):
+    def getter(self):
+        return getattr(self.type, attr)
+    return property(getter)
+
+# drawing of the cells out of sight
+DARK = "\\C1; "
+
+class BaseTile:
+    __slots__ = ()
+    rchar = type_property("rchar")
+    desc = type_property("desc")
+    openable = type_property("openable")
+    replace_fam = type_property("replace_fam")
+    family = type_property("family")
+    @property
+    def char(self):
+        return self.type.char
+    @char.setter
+    def char(self, value):
+        self.type = self.type.replace(char=value)
     def draw(self):
         if self.highlight:
             color = "\\C10;"
@@ -29,9 +72,9 @@ class Tile:
             color = "\\C8;"
         elif self.lit == 1:
             color = "\\C9;"
-            return "\\C1; "
+            return DARK
         else:
-            return "\\C1; "
+            return DARK
         if self.creatures and self.lit == 2:
             char = state.game_frame.get_creature(self.creatures[-1]).draw()
         elif self.items and self.lit == 2:
@@ -39,30 +82,128 @@ class Tile:
         else:
             char = self.char
         return color + char
+    def flags(self):
+        flags = grid.PRESENT | (self.lit << grid.LIT_SHIFT)
+        if self.wall:
+            flags |= grid.WALL
+        if self.obscure:
+            flags |= grid.OBSCURE
+        if self.known:
+            flags |= grid.KNOWN
+        if self.highlight:
+            flags |= grid.HIGHLIGHT
+        return flags
+    def __bool__(self):
+        return True
+
+class Tile(BaseTile):
+    # Only holds what is specific to a cell, the rest is in its TileType
+    __slots__ = ("type", "wall", "obscure", "lit", "known", "highlight", "_creatures", "_items")
+    def __init__(self, type, wall=None, obscure=None):
+        self.type = type
+        # wall and obscure change when a door is opened or closed
+        self.wall = type.wall if wall == None else wall
+        if obscure != None:
+            self.obscure = obscure
+        elif wall != None:
+            self.obscure = wall
+        else:
+            self.obscure = type.obscure
+        # lit
+        #  0 - not lit (invisible)
+        #  1 - known, but not lit (grey, doesn't show monsters)
+        #  2 - completly lit (black, shows everything)
+        self.lit = 2
+        self.highlight = False
+        self.known = False
+        # occupants are only allocated when needed
+        self._creatures = None
+        self._items = None
+    @property
+    def creatures(self):
+        return self._creatures or ()
+    @property
+    def items(self):
+        return self._items or ()
     def add_creature(self, creature):
-        self.creatures.append(creature)
+        if self._creatures is None:
+            self._creatures = []
+        self._creatures.append(creature)
     def remove_creature(self, creature):
         try:
-            self.creatures.remove(creature)
+            self._creatures.remove(creature)
+        except (ValueError, AttributeError):
+            state.warning("Trying to remove %s, whereas there are no such entity in that tile." % creature)
+
+def flag_property(bit):
+    def getter(self):
+        return bool(self.chunk.flags[self.index] & bit)
+    def setter(self, value):
+        if value:
+            self.chunk.flags[self.index] |= bit
+        else:
+            self.chunk.flags[self.index] &= ~bit
+    return property(getter, setter)
+
+class TileView(BaseTile):
+    # Lightweight view over a cell of a grid.ChunkedGrid, behaving as a Tile
+    __slots__ = ("grid", "pos", "chunk", "index")
+    def __init__(self, grid, pos, chunk, index):
+        self.grid = grid
+        self.pos = pos
+        self.chunk = chunk
+        self.index = index
+    @property
+    def type(self):
+        return TileType.types[self.chunk.ids[self.index]]
+    @type.setter
+    def type(self, type):
+        self.chunk.ids[self.index] = type.id
+    wall = flag_property(grid.WALL)
+    obscure = flag_property(grid.OBSCURE)
+    known = flag_property(grid.KNOWN)
+    highlight = flag_property(grid.HIGHLIGHT)
+    @property
+    def lit(self):
+        return (self.chunk.flags[self.index] & grid.LIT) >> grid.LIT_SHIFT
+    @lit.setter
+    def lit(self, value):
+        self.chunk.flags[self.index] = (self.chunk.flags[self.index] & ~grid.LIT) | (value << grid.LIT_SHIFT)
+    @property
+    def creatures(self):
+        return self.grid.creatures.get(self.pos, ())
+    @property
+    def items(self):
+        return self.grid.items.get(self.pos, ())
+    def add_creature(self, creature):
+        self.grid.add_occupant(self.grid.creatures, self.pos, creature)
+    def remove_creature(self, creature):
+        try:
+            self.grid.remove_occupant(self.grid.creatures, self.pos, creature)
         except ValueError:
             state.warning("Trying to remove %s, whereas there are no such entity in that tile." % creature)
-    def __bool__(self):
-        return True
+    def clear_creatures(self):
+        self.grid.creatures.pop(self.pos, None)
 
 class NoTile:
     def __init__(self):
         self.wall = True
         self.obscure = True
-        self.creatures = []
-        self.items = []
+        self.creatures = ()
+        self.items = ()
         self.known = False
         self.highlight = False
         self.rchar = None
     def draw(self):
         return " "
+    def clear_creatures(self):
+        pass
     def __bool__(self):
         return False
 
+# Shared by every lookup outside of a map
+NO_TILE = NoTile()
+
 class LCRNG:
     # Linear Congruential Random Numbers Generator
     M = 2147483647
@@ -289,14 +430,14 @@ class BSP(MapGenerator):
             y, x = room.y, room.x
             for i in range(room.width+1):
                 for j in range(room.height+1):
-                    map[y+j,x+i] = Tile(".", False)
+                    map[y+j,x+i] = Tile(GROUND_TILE)
             for i in range(room.width+1):
-                map[y,x+i] = Tile("#", True)
-                map[y+room.height,x+i] = Tile("#", True)
+                map[y,x+i] = Tile(WALL_TILE)
+                map[y+room.height,x+i] = Tile(WALL_TILE)
             for i in range(room.height+1):
-                map[y+i,x] = Tile("#", True)
-                map[y+i,x+room.width] = Tile("#", True)
-            map[y+room.door[0], x+room.door[1]] = Tile("+", False)
+                map[y+i,x] = Tile(WALL_TILE)
+                map[y+i,x+room.width] = Tile(WALL_TILE)
+            map[y+room.door[0], x+room.door[1]] = Tile(DOOR_TILE, wall=False)
         return map
 
 class BlockAgregation(MapGenerator):
@@ -342,10 +483,10 @@ class BlockAgregation(MapGenerator):
 
 class CustomRoom:
     def __init__(self, x, y, width, height):
-        self.chars = [[Tile("#", True) for i in range(width)] for i in range(height)]
+        self.chars = [[Tile(WALL_TILE) for i in range(width)] for i in range(height)]
         for j in range(1, height-1):
             for i in range(1, width-1):
-                self.chars[j][i] = Tile(".", False)
+                self.chars[j][i] = Tile(GROUND_TILE)
         self.x = x
         self.y = y
         self.width = width
@@ -370,17 +511,17 @@ class CustomRoom:
             for i, c in enumerate(line):
                 yield (self.y+j,self.x+i), c
     def create_door(self):
-        is_open_default = False
+        is_open_default = True
         for i, door in enumerate(self.doors):
             if door == None: continue
             if i == 2:
-                self.chars[0][door] = Tile("+", is_open_default)
+                self.chars[0][door] = Tile(DOOR_TILE, wall=not is_open_default)
             elif i == 3:
-                self.chars[door][self.width-1] = Tile("+", is_open_default)
+                self.chars[door][self.width-1] = Tile(DOOR_TILE, wall=not is_open_default)
             elif i == 0:
-                self.chars[self.height-1][door] = Tile("+", is_open_default)
+                self.chars[self.height-1][door] = Tile(DOOR_TILE, wall=not is_open_default)
             elif i == 1:
-                self.chars[door][0] = Tile("+", is_open_default)
+                self.chars[door][0] = Tile(DOOR_TILE, wall=not is_open_default)
     def __str__(self):
         return "CustomRoom<%s,%s,%s,%s>" % (self.y, self.x, self.height, self.width)
     def __repr__(self):
@@ -434,30 +575,30 @@ class CustomGenerator(MapGenerator):
                 y += 1
                 x += room.doors[odir]
                 for i in range(distance):
-                    map[y-(i+2),x+1] = Tile("#", True)
-                    map[y-(i+2),x] = Tile(".", False)
-                    map[y-(i+2),x-1] = Tile("#", True)
+                    map[y-(i+2),x+1] = Tile(WALL_TILE)
+                    map[y-(i+2),x] = Tile(GROUND_TILE)
+                    map[y-(i+2),x-1] = Tile(WALL_TILE)
             elif dir == 1:
                 y += room.doors[odir]
                 x += room.width
                 for i in range(distance):
-                    map[y+1,x+i] = Tile("#", True)
-                    map[y,x+i] = Tile(".", False)
-                    map[y-1,x+i] = Tile("#", True)
+                    map[y+1,x+i] = Tile(WALL_TILE)
+                    map[y,x+i] = Tile(GROUND_TILE)
+                    map[y-1,x+i] = Tile(WALL_TILE)
             elif dir == 2:
                 y += room.height
                 x += room.doors[odir]
                 for i in range(distance):
-                    map[y+i,x-1] = Tile("#", True)
-                    map[y+i,x] = Tile(".", False)
-                    map[y+i,x+1] = Tile("#", True)
+                    map[y+i,x-1] = Tile(WALL_TILE)
+                    map[y+i,x] = Tile(GROUND_TILE)
+                    map[y+i,x+1] = Tile(WALL_TILE)
             elif dir == 3:
                 y += room.doors[odir]
                 x += 1
                 for i in range(distance):
-                    map[y-1,x-(i+2)] = Tile("#", True)
-                    map[y,x-(i+2)] = Tile(".", False)
-                    map[y+1,x-(i+2)] = Tile("#", True)
+                    map[y-1,x-(i+2)] = Tile(WALL_TILE)
+                    map[y,x-(i+2)] = Tile(GROUND_TILE)
+                    map[y+1,x-(i+2)] = Tile(WALL_TILE)
         return map
     def door_pos(self, size1, size2):
         size1 -= 2
@@ -535,179 +676,350 @@ GENERATE_OPS = [
     }
 ]
             
+# Family replacement: a tile takes the glyph of its family matching which of
+# its neighboors are of the same family, as a 4 bits mask
+FAMILY_UP = 1
+FAMILY_RIGHT = 2
+FAMILY_DOWN = 4
+FAMILY_LEFT = 8
+FAMILY_DIRS = ((FAMILY_UP, state.UP), (FAMILY_RIGHT, state.RIGHT), (FAMILY_DOWN, state.DOWN), (FAMILY_LEFT, state.LEFT))
+# mask -> index of the glyph in the family (.fmly file):
+#  ═ ║ ╔ ╗ ╚ ╝ ╠ ╣ ╦ ╩ ╬
+FAMILY_GLYPHS = (0, 1, 0, 4, 1, 1, 2, 6, 0, 5, 0, 9, 3, 7, 8, 10)
+
 class Map:
+    JOURNAL_EXTENSION = ".jnl"
+    # saves kept in the journal before it is compacted into the map file
+    COMPACT_EVERY = 20
     def __init__(self):
-        self.map = {}
+        self.grid = grid.ChunkedGrid()
         self.is_custom = False
         self.file = ""
         self.has_map = False
+        self.families = None
+        # grid.Bitmaps of the grid, see bitmaps
+        self.packed = None
+        self.reset_saved()
     def __getitem__(self, pos):
-        if pos in self.map:
-            return self.map[pos]
-        else:
-            return NoTile()
+        key = (pos[0] >> grid.CHUNK_SHIFT, pos[1] >> grid.CHUNK_SHIFT)
+        chunk = self.grid.chunks.get(key)
+        if chunk is None and self.grid.lazy:
+            chunk = self.grid.chunk(key)
+        if chunk is not None:
+            index = ((pos[0] & grid.CHUNK_MASK) << grid.CHUNK_SHIFT) | (pos[1] & grid.CHUNK_MASK)
+            if chunk.flags[index] & grid.PRESENT:
+                return TileView(self.grid, pos, chunk, index)
+        return NO_TILE
+    def cell_flags(self, pos):
+        # flags of the cell at pos, 0 outside of the map: what map[pos] reads,
+        # without making a TileView
+        key = (pos[0] >> grid.CHUNK_SHIFT, pos[1] >> grid.CHUNK_SHIFT)
+        chunk = self.grid.chunks.get(key)
+        if chunk is None and self.grid.lazy:
+            chunk = self.grid.chunk(key)
+        if chunk is None:
+            return 0
+        return chunk.flags[((pos[0] & grid.CHUNK_MASK) << grid.CHUNK_SHIFT) | (pos[1] & grid.CHUNK_MASK)]
+    def walkable(self, pos):
+        # not map[pos].wall, the creatures aside
+        return bool(grid.WALKABLE[self.cell_flags(pos)])
+    def draw_cell(self, pos):
+        # map[pos].draw(), None outside of the map; the cells neither lit nor
+        # highlighted, drawn the same, are drawn without their tile
+        flags = self.cell_flags(pos)
+        if not flags & grid.PRESENT:
+            return None
+        if flags & grid.HIGHLIGHT or flags & grid.LIT == 2 << grid.LIT_SHIFT:
+            return self[pos].draw()
+        return DARK
+    def __setitem__(self, pos, tile):
+        self.set_tile(pos, tile)
+        self.grid.touch(pos)
+        if self.families != None:
+            self.retile(pos)
+    def set_tile(self, pos, tile):
+        self.grid.set(pos, tile.type.id, tile.flags())
+        for creature in tile.creatures:
+            self.grid.add_occupant(self.grid.creatures, pos, creature)
+        for item in tile.items:
+            self.grid.add_occupant(self.grid.items, pos, item)
+    def __contains__(self, pos):
+        return pos in self.grid
+    @property
+    def revision(self):
+        # changes with the opacity of the tiles, or with the grid
+        return self.grid.revision
+    def bitmaps(self):
+        # the grid.Bitmaps of the map, brought up to date with the cells
+        # changed since they were last used, or built again
+        packed = self.packed
+        if packed == None or packed.grid is not self.grid:
+            packed = self.packed = grid.Bitmaps(self.grid)
+        elif packed.revision != self.grid.revision:
+            cells = self.grid.changes_since(packed.revision)
+            if cells == None or not all(packed.update(pos) for pos in cells):
+                packed = self.packed = grid.Bitmaps(self.grid)
+            packed.revision = self.grid.revision
+        return packed
+    def set_tiles(self, tiles):
+        self.grid = grid.ChunkedGrid()
+        for pos, tile in tiles.items():
+            self.set_tile(pos, tile)
+    def clear_creatures(self, pos):
+        self.grid.creatures.pop(pos, None)
     def unhighlight(self):
-        for tile in self.map.values():
-            tile.highlight = False
+        self.grid.translate(grid.UNHIGHLIGHT)
     def unlit(self):
-        for tile in self.map.values():
-            tile.lit = 0
+        self.grid.translate(grid.UNLIT)
     def lit_known(self):
-        for tile in self.map.values():
-            if tile.lit == 0 and tile.known:
-                tile.lit = 1
+        self.grid.translate(grid.LIT_KNOWN)
     def lit(self):
-        for tile in self.map.values():
-            tile.lit = 2
+        self.grid.translate(grid.LIT_ALL)
     def reset(self):
-        for tile in self.map.values():
-            tile.creatures.clear()
-            tile.items.clear()
+        self.grid.clear_occupants()
+    def set_state(self, pos, wall, obscure=None):
+        # changes the state of a tile (e.g. an opened door), which is saved
+        tile = self[pos]
+        tile.wall = wall
+        tile.obscure = wall if obscure == None else obscure
+        self.changed_tiles.add(pos)
+        self.grid.touch(pos)
+        self.retile(pos)
     def load_custom(self):
         #gen = BSP(60, 40, 3, dispatch=.5)
-        self.custom = True
+        self.is_custom = True
         self.has_map = True
         ops = GENERATE_OPS[2]
         gen = ops["gen"](*ops["args"], **ops["kwargs"])
-        self.map = gen.generate()
+        self.set_tiles(gen.generate())
         state.game_frame.pre_load()
         state.game_frame.load_creatures([creature.Hero(pos=(1,1),creature_id=0)])
         state.game_frame.load_items([])
-    def tile2dict(self, tile, file):
-        tile = tile.replace("\n","")
-        result = {
-            "wall": True,
-            "obscure": False,
-            "desc": "tile",
-            "openable": False,
-            "replace-family": False,
-            'family': None
-        }
-        rkey = None
-        for entry in tile.split(";;"):
-            if not entry.replace(" ", "").replace("\t",""):
-                continue
-            key, value = entry.split(" ",1)
-            value = eval(value)
-            if key == 'char':
-                rkey = value
-                result[key] = value
-            elif key in {"wall", "obscure", "desc", "openable", "char", 'repr', 'replace-family', 'family'}:
-                result[key] = value
-            else:
-                state.warning("Tile %s contains an wrong entry: %s" % (file[:-3], key))
-        if rkey == None:
-            state.warning("Tile %s doesn't contain a `char' entry, this shouldn't happend." % file[:-3])
-            rkey = '\x00'
-        if not 'repr' in result:
-            result['repr'] = rkey
-        return rkey, result
-                
     def load_tiles(self):
-        self.tiles = {}
-        pwd, _, files = next(os.walk(state.realpath('tiles')))
-        for file in files:
-            if not file.endswith(".tl"):
-                continue
-            with open(os.path.join(pwd, file)) as f:
-                key, tile = self.tile2dict(f.read(), file)
-                self.tiles[key] = tile
+        self.tiles = assets.load_tiles()
+    def family_at(self, pos):
+        chunk, index = self.grid.locate(pos)
+        if chunk is None or not chunk.flags[index] & grid.PRESENT:
+            return None
+        return TileType.types[chunk.ids[index]].family
+    def family_mask(self, pos, family):
+        # bits of the neighboors of the same family, see FAMILY_GLYPHS
+        mask = 0
+        for bit, dir in FAMILY_DIRS:
+            if family is not None and self.family_at((pos[0]+dir[0], pos[1]+dir[1])) == family:
+                mask |= bit
+        return mask
     def adapt_neighboors(self, pos):
-        family = self[pos].family
-        up = bool(self[state.add_tuples(pos, state.UP)] and self[state.add_tuples(pos, state.UP)].family and self.map[state.add_tuples(pos, state.UP)].family == family)
-        right = bool(self[state.add_tuples(pos, state.RIGHT)] and self[state.add_tuples(pos, state.RIGHT)].family and self.map[state.add_tuples(pos, state.RIGHT)].family == family)
-        down = bool(self[state.add_tuples(pos, state.DOWN)] and self[state.add_tuples(pos, state.DOWN)].family and self.map[state.add_tuples(pos, state.DOWN)].family == family)
-        left = bool(self[state.add_tuples(pos, state.LEFT)] and self[state.add_tuples(pos, state.LEFT)].family and self.map[state.add_tuples(pos, state.LEFT)].family == family)
-        n = (up,right,down,left)
-        if n == (True, False, True, False):
-            return 1
-        elif n == (False, True, False, True):
-            return 0
-        elif n == (False, True, True, False):
-            return 2
-        elif n == (False, False, True, True):
-            return 3
-        elif n == (True, True, False, False):
-            return 4
-        elif n == (True, False, False, True):
-            return 5
-        elif n == (True, True, True, False):
-            return 6
-        elif n == (True, False, True, True):
-            return 7
-        elif n == (False, True, True, True):
-            return 8
-        elif n == (True, True, False, True):
-            return 9
-        elif n == (True, True, True, True):
-            return 10
-        elif n == (True, False, False, False):
-            return 1
-        elif n == (False, False, True, False):
-            return 1
-        elif n == (False, True, False, False):
-            return 0
-        elif n == (False, False, False, True):
-            return 0
-        else:
-            return 0
+        return FAMILY_GLYPHS[self.family_mask(pos, self.family_at(pos))]
+    def replaced_type(self, type, mask):
+        # type with the glyph of its family matching `mask'
+        key = (type.id, mask)
+        if key not in self.replaced:
+            self.replaced[key] = type.replace(char=self.families[type.replace_fam][FAMILY_GLYPHS[mask]])
+        return self.replaced[key]
+    def retile(self, pos):
+        # updates the glyphs around a changed cell
+        if self.families == None:
+            self.load_families()
+        for y in range(pos[0]-1, pos[0]+2):
+            for x in range(pos[1]-1, pos[1]+2):
+                chunk, index = self.grid.locate((y,x))
+                if chunk is None or not chunk.flags[index] & grid.PRESENT:
+                    continue
+                type = TileType.types[chunk.ids[index]]
+                if type.replace_fam in self.families:
+                    chunk.ids[index] = self.replaced_type(type, self.family_mask((y,x), type.family)).id
     def load_families(self):
-        self.families = {}
-        pwd, _, files = next(os.walk(state.realpath('tiles')))
-        for file in files:
-            if not file.endswith(".fmly"):
+        self.families = assets.load("families")
+        # replaced types: (type id, mask) -> type
+        self.replaced = {}
+    def read_row(self, y, line, types):
+        # returns the families of the row, and the tiles to replace
+        families = []
+        replace = []
+        for x, char in enumerate(line):
+            if char in types:
+                type = types[char]
+            elif char == ' ':
+                families.append(None)
                 continue
-            with open(os.path.join(pwd, file)) as f:
-                self.families[file[:-5]] = f.read()
-            
+            else:
+                state.warning("Tile not defined at (%s,%s): %s" % (y, x, char))
+                type = types[char] = TileType(char, char, False)
+            self.grid.set((y,x), type.id, type.flags)
+            families.append(type.family)
+            if type.replace_fam:
+                replace.append((x, type))
+        return families, replace
+    def replace_row(self, y, above, row, below):
+        # family replacement of a row, knowing the rows above and below
+        families, replace = row
+        above = above[0] if above is not None else ()
+        below = below[0] if below is not None else ()
+        for x, type in replace:
+            if type.replace_fam not in self.families:
+                state.warning("Tile %s(%s,%s) requires family replacement, but there is no such family" % (type.rchar, y, x))
+                continue
+            family = families[x]
+            mask = 0
+            if family is not None:
+                if x < len(above) and above[x] == family:
+                    mask |= FAMILY_UP
+                if x+1 < len(families) and families[x+1] == family:
+                    mask |= FAMILY_RIGHT
+                if x < len(below) and below[x] == family:
+                    mask |= FAMILY_DOWN
+                if x > 0 and families[x-1] == family:
+                    mask |= FAMILY_LEFT
+            new = self.replaced_type(type, mask)
+            self.grid.set((y,x), new.id, new.flags)
+    def read(self, file):
+        # builds the grid from a .mp file, streaming it row by row, and
+        # returns its entities
+        self.grid = grid.ChunkedGrid()
+        types = {char: TileType(t.char, t.repr, t.wall, t.obscure, t.desc, t.openable, t.replace_family, t.family) for char, t in self.tiles.items()}
+        with open(file) as f:
+            objs = savefile.read_objs(f.readline)
+            # a row is replaced once the next one has been read
+            above = row = None
+            for y, line in enumerate(f):
+                below = self.read_row(y, line.rstrip("\n"), types)
+                if row is not None:
+                    self.replace_row(y-1, above, row, below)
+                above, row = row, below
+            if row is not None:
+                self.replace_row(y, above, row, None)
+        return objs
     def load(self):
-        self.load_families()
-        self.load_tiles()
-        self.map = {}
-        with open(self.file) as f:
-            objs, *self.map_lines = f.read().split("\n")
-        for y, line in enumerate(self.map_lines):
-            for x, char in enumerate(line):
-                if char in self.tiles:
-                    t = self.tiles[char]
-                    self.map[y,x] = Tile(t['char'], t['repr'], t['wall'], t['obscure'], t['desc'], t['openable'], t['replace-family'], t['family'])
-                elif char == ' ':
-                    continue
-                else:
-                    state.warning("Tile not defined at (%s,%s): %s" % (y, x, char))
-                    self.map[y,x] = Tile(char, True, False)
-        for y, line in enumerate(self.map_lines):
-            for x in range(len(line)):
-                if (y,x) not in self.map:
-                    continue
-                tile = self.map[y,x]
-                if not (tile and tile.replace_fam):
-                    continue
-                if tile.replace_fam not in self.families:
-                    state.warning("Tile %s(%s,%s) requires family replacement, but there is no such family" % (tile.rchar, y, x))
-                    continue
-                tile.char = self.families[tile.replace_fam][self.adapt_neighboors((y,x))]
-        objs = json.loads(objs)
+        if mapfile.is_fresh(self.file):
+            self.grid = mapfile.open_map(mapfile.compiled_name(self.file))
+            # decoded block by block, straight into the saved entities
+            tiles, entities = self.grid.stream_objs()
+        else:
+            self.load_families()
+            self.load_tiles()
+            objs = self.read(self.file)
+            tiles = objs.get("tiles", [])
+            entities = ((kind, entity) for kind in ("creatures", "items") for entity in objs[kind])
+        self.reset_saved()
+        saved = {"creatures": {}, "items": {}}
+        for kind, entity in entities:
+            saved[kind][entity.get("uuid", 0)] = entity
+        saved_creatures = saved["creatures"]
+        saved_items = saved["items"]
+        self.apply_tiles(tiles)
+        for record in self.read_journal():
+            self.apply_record(record, saved_creatures, saved_items)
+            self.journal_size += 1
+        self.saved["creatures"] = {uuid: self.dumps(c) for uuid, c in saved_creatures.items()}
+        self.saved["items"] = {uuid: self.dumps(item) for uuid, item in saved_items.items()}
         state.game_frame.pre_load()
-        state.game_frame.load_creatures([creature.creature_map[c["creature_id"]](**c) for c in objs["creatures"]])
-        state.game_frame.load_items([items.item_map[item["item_id"]](**item) for item in objs["items"]])
+        state.game_frame.load_creatures([creature.creature_map[c["creature_id"]](**c) for c in saved_creatures.values()])
+        state.game_frame.load_items([items.item_map[item["item_id"]](**item) for item in saved_items.values()])
+    ### Saves
+    # A save appends the changes since the last one to a journal, one JSON
+    # record per line:
+    #  {"creatures": {uuid: save}, "items": {uuid: save},
+    #   "removed": {"creatures": [uuid], "items": [uuid]},
+    #   "tiles": [[y, x, wall, obscure]]}
+    # Records hold absolute values, so replaying one twice is harmless.
+    # The journal is compacted into a fresh map file from time to time.
+    def reset_saved(self):
+        # what has been saved, as JSON strings
+        self.saved = {"creatures": {}, "items": {}}
+        # states of the tiles differing from their type: pos -> (wall, obscure)
+        self.saved_tiles = {}
+        self.changed_tiles = set()
+        self.journal_size = 0
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj, sort_keys=True)
+    def journal_file(self):
+        return os.path.splitext(self.file)[0] + self.JOURNAL_EXTENSION
+    def read_journal(self):
+        if not os.path.exists(self.journal_file()):
+            return
+        with open(self.journal_file()) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    def save_tile(self, pos, tile):
+        if (tile.wall, tile.obscure) == (tile.type.wall, tile.type.obscure):
+            self.saved_tiles.pop(pos, None)
+        else:
+            self.saved_tiles[pos] = (tile.wall, tile.obscure)
+    def apply_tiles(self, tiles):
+        for y, x, wall, obscure in tiles:
+            tile = self[y,x]
+            if tile:
+                tile.wall = wall
+                tile.obscure = obscure
+                self.save_tile((y,x), tile)
+        self.grid.touch()
+    def apply_record(self, record, creatures, items):
+        for kind, entities in (("creatures", creatures), ("items", items)):
+            for uuid, entity in record.get(kind, {}).items():
+                entities[int(uuid)] = entity
+            for uuid in record.get("removed", {}).get(kind, []):
+                entities.pop(uuid, None)
+        self.apply_tiles(record.get("tiles", []))
+    def changes(self):
+        # record of what changed since the last save, updates self.saved
+        record = {"creatures": {}, "items": {}, "removed": {"creatures": [], "items": []}, "tiles": []}
+        for kind, entities in (("creatures", state.game_frame.creatures), ("items", state.game_frame.items)):
+            saved = self.saved[kind]
+            for uuid, entity in entities.items():
+                dump = self.dumps(entity.save())
+                if saved.get(uuid) != dump:
+                    saved[uuid] = dump
+                    record[kind][uuid] = json.loads(dump)
+            for uuid in set(saved) - set(entities):
+                del saved[uuid]
+                record["removed"][kind].append(uuid)
+        for pos in sorted(self.changed_tiles):
+            tile = self[pos]
+            self.save_tile(pos, tile)
+            record["tiles"].append([pos[0], pos[1], tile.wall, tile.obscure])
+        self.changed_tiles.clear()
+        return record
     def save(self):
         if not self.has_map or self.is_custom:
             return 0
-        objs = {
-            "creatures": [
-                c.save() for c in state.game_frame.creatures.values()
-            ],
-            "items": [
-                item.save() for item in state.game_frame.items.values()
-            ]
-        }
-        with open(self.file, "w") as f:
-            f.write(json.dumps(objs) + "\n")
-            f.write("\n".join(self.map_lines))
+        record = self.changes()
+        if any(record["removed"].values()) or any(record[key] for key in ("creatures", "items", "tiles")):
+            with open(self.journal_file(), "a") as f:
+                f.write(json.dumps(record) + "\n")
+            self.journal_size += 1
+        if self.journal_size >= self.COMPACT_EVERY:
+            self.compact()
         return 1
+    def compact(self):
+        # writes the saved state into a fresh map file, and empties the journal
+        if not self.has_map or self.is_custom or not self.journal_size:
+            return
+        creatures = (json.loads(c) for c in self.saved["creatures"].values())
+        items = (json.loads(item) for item in self.saved["items"].values())
+        tiles = [[y, x, wall, obscure] for (y, x), (wall, obscure) in sorted(self.saved_tiles.items())]
+        with open(self.file + ".tmp", "w") as f:
+            savefile.write_objs(f.write, creatures, items, tiles, (len(self.saved["creatures"]), len(self.saved["items"])))
+            f.write("\n".join(self.dump_lines()))
+        os.replace(self.file + ".tmp", self.file)
+        # the journal only goes once the new map file is there
+        os.remove(self.journal_file())
+        self.journal_size = 0
+    def dump_lines(self):
+        # lines of a .mp file, from the grid
+        bounds = self.grid.bounds()
+        if bounds is None:
+            return []
+        lines = [[" "]*(bounds[3]+1) for y in range(bounds[2]+1)]
+        for y, x in self.grid.positions():
+            if y >= 0 and x >= 0:
+                lines[y][x] = self[y,x].rchar
+        return ["".join(line).rstrip() for line in lines]
+    @state.metrics.timed("map_load")
     def load_file(self, file):
         self.has_map = True
-        self.custom = False
+        self.is_custom = False
         self.file = file
         self.load()
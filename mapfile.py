@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+### Map file module
+# Compiled maps (.mpc): a binary image of a map, opened through mmap so that
+# a level is usable without reading every cell up front.
+# Compile with: python3 mapfile.py [maps/*.mp]
+#
+# Layout (little endian):
+#  header   - MAGIC, VERSION, height, width, origin (y, x) of the map,
+#             number of tiles, then (offset, size) of each section
+#  types    - JSON list of the tile types, a file id being the index
+#  tile ids - height*width uint16, row major (0 where there is no tile)
+#  flags    - height*width bytes, the grid flags of each cell
+#  entities - entity section, see savefile
+
+import array, io, json, mmap, os, struct, sys
+import grid, state, savefile
+
+MAGIC = b"BOVM"
+VERSION = 1
+HEADER = struct.Struct("<4sHHiiiiI8I")
+EXTENSION = ".mpc"
+
+# flags that make sense outside of a game
+SAVED_FLAGS = grid.PRESENT | grid.WALL | grid.OBSCURE
+
+def save_table(saved):
+    return bytes(i & saved for i in range(256))
+
+def keep_table(saved):
+    # flags of a loaded cell: the saved ones, and lit
+    return bytes(i & saved | (2 << grid.LIT_SHIFT if i & grid.PRESENT else 0) for i in range(256))
+
+SAVE = save_table(SAVED_FLAGS)
+KEEP_SAVED = keep_table(SAVED_FLAGS)
+PRESENCE = bytes(i & grid.PRESENT for i in range(256))
+
+class MapFileError(Exception):
+    pass
+
+def compiled_name(file):
+    return os.path.splitext(file)[0] + EXTENSION
+
+def sources_mtime(file):
+    # a compiled map also depends on the tiles and families
+    mtime = os.path.getmtime(file)
+    pwd, _, files = next(os.walk(state.realpath("tiles")))
+    for name in files:
+        if name.endswith(".tl") or name.endswith(".fmly"):
+            mtime = max(mtime, os.path.getmtime(os.path.join(pwd, name)))
+    return mtime
+
+def is_fresh(file):
+    # whether the compiled version of `file' can be used instead
+    compiled = compiled_name(file)
+    return os.path.exists(compiled) and os.path.getmtime(compiled) >= sources_mtime(file)
+
+def type2list(type):
+    return [type.rchar, type.char, type.wall, type.obscure, type.desc, type.openable, type.replace_fam, type.family]
+
+def write_grid(target, cells, objs, saved=SAVED_FLAGS):
+    # cells: ChunkedGrid, objs: the entities, saved: the flags written
+    save = SAVE if saved == SAVED_FLAGS else save_table(saved)
+    bounds = cells.bounds()
+    if bounds is None:
+        bounds = (0, 0, -1, -1)
+    y0, x0, y1, x1 = bounds
+    height, width = y1-y0+1, x1-x0+1
+    ids = array.array("H", bytes(2*height*width))
+    flags = bytearray(height*width)
+    # ids are written as they are, so every type known up to now is saved
+    types = [type2list(type) for type in state.map.TileType.types]
+    for (cy, cx), chunk in cells.chunks.items():
+        x = (cx << grid.CHUNK_SHIFT) - x0
+        left = max(0, -x)
+        right = min(grid.CHUNK_SIZE, width - x)
+        for row in range(grid.CHUNK_SIZE):
+            y = (cy << grid.CHUNK_SHIFT) + row - y0
+            if not 0 <= y < height:
+                continue
+            start = row << grid.CHUNK_SHIFT
+            offset = y*width + x
+            ids[offset+left:offset+right] = chunk.ids[start+left:start+right]
+            flags[offset+left:offset+right] = chunk.flags[start+left:start+right].translate(save)
+    if sys.byteorder == "big":
+        ids.byteswap()
+    entities = io.StringIO()
+    savefile.write_objs(entities.write, objs["creatures"], objs["items"], objs.get("tiles", []))
+    sections = [json.dumps(types).encode(), ids.tobytes(), bytes(flags), entities.getvalue().encode()]
+    offset = HEADER.size
+    table = []
+    for section in sections:
+        table += [offset, len(section)]
+        offset += len(section)
+    # written aside, so that a mapped version of the file stays valid
+    with open(target + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, height, width, y0, x0, len(cells), *table))
+        for section in sections:
+            f.write(section)
+    os.replace(target + ".tmp", target)
+
+def compile_map(file, target=None):
+    m = state.map.Map()
+    m.load_families()
+    m.load_tiles()
+    objs = m.read(file)
+    write_grid(target or compiled_name(file), m.grid, objs)
+
+class MappedGrid(grid.ChunkedGrid):
+    # ChunkedGrid whose chunks are read from a compiled map on first access
+    lazy = True
+    def __init__(self, file, saved=SAVED_FLAGS):
+        grid.ChunkedGrid.__init__(self)
+        with open(file, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, _, self.height, self.width, self.y0, self.x0, self.size, *table = HEADER.unpack_from(self.mm)
+        except struct.error:
+            raise MapFileError("%s is too short to be a compiled map" % file)
+        if magic != MAGIC or version != VERSION:
+            raise MapFileError("%s isn't a compiled map of version %s" % (file, VERSION))
+        self.sections = [(table[i], table[i+1]) for i in range(0, len(table), 2)]
+        types = json.loads(self.section(0))
+        self.types = [state.map.TileType(*type).id for type in types]
+        self.remap = self.types != list(range(len(self.types)))
+        self.ids_offset = self.sections[1][0]
+        self.flags_offset = self.sections[2][0]
+        # composition of the flag translations applied to the loaded chunks,
+        # still to be applied to the others
+        self.pending = KEEP_SAVED if saved == SAVED_FLAGS else keep_table(saved)
+        self.tried = set()
+    def section(self, n):
+        offset, size = self.sections[n]
+        return self.mm[offset:offset+size]
+    def readline(self, n):
+        # readline over the section n, read from the mapping line by line
+        position, size = self.sections[n]
+        end = position + size
+        def readline():
+            nonlocal position
+            if position >= end:
+                return ""
+            stop = self.mm.find(b"\n", position, end)
+            stop = end if stop == -1 else stop + 1
+            line = self.mm[position:stop].decode()
+            position = stop
+            return line
+        return readline
+    def stream_objs(self):
+        # (tiles, entities) of the map, see savefile.stream_objs
+        return savefile.stream_objs(self.readline(3))
+    @property
+    def objs(self):
+        # every entity of the map at once, see savefile.read_objs
+        return savefile.read_objs(self.readline(3))
+    def chunk(self, key):
+        if key not in self.tried:
+            self.tried.add(key)
+            chunk = self.load_chunk(key)
+            if chunk is not None:
+                self.chunks[key] = chunk
+        return self.chunks.get(key)
+    def load_chunk(self, key):
+        y0 = (key[0] << grid.CHUNK_SHIFT) - self.y0
+        x0 = (key[1] << grid.CHUNK_SHIFT) - self.x0
+        if y0 + grid.CHUNK_SIZE <= 0 or y0 >= self.height or x0 + grid.CHUNK_SIZE <= 0 or x0 >= self.width:
+            return None
+        chunk = grid.Chunk()
+        # part of the chunk inside of the map
+        left = max(0, -x0)
+        right = min(grid.CHUNK_SIZE, self.width - x0)
+        for row in range(max(0, -y0), min(grid.CHUNK_SIZE, self.height - y0)):
+            offset = (y0+row)*self.width + x0
+            start = (row << grid.CHUNK_SHIFT)
+            flags = self.mm[self.flags_offset+offset+left:self.flags_offset+offset+right]
+            chunk.flags[start+left:start+right] = flags
+            ids = array.array("H")
+            ids.frombytes(self.mm[self.ids_offset+2*(offset+left):self.ids_offset+2*(offset+right)])
+            chunk.ids[start+left:start+right] = ids
+        chunk.count = grid.CHUNK_AREA - chunk.flags.translate(PRESENCE).count(0)
+        if chunk.count == 0:
+            return None
+        if sys.byteorder == "big":
+            chunk.ids.byteswap()
+        if self.remap:
+            chunk.ids = array.array("H", (self.types[i] for i in chunk.ids))
+        chunk.flags = chunk.flags.translate(self.pending)
+        return chunk
+    def load_all(self):
+        for cy in range((self.y0 >> grid.CHUNK_SHIFT), ((self.y0 + self.height - 1) >> grid.CHUNK_SHIFT) + 1):
+            for cx in range((self.x0 >> grid.CHUNK_SHIFT), ((self.x0 + self.width - 1) >> grid.CHUNK_SHIFT) + 1):
+                self.chunk((cy, cx))
+    def fill_bitmaps(self, bitmaps):
+        # straight from the flag layer, without loading the chunks; the chunks
+        # already tried are copied over it, as they may have changed since
+        for row in range(self.height):
+            offset = self.flags_offset + row*self.width
+            bitmaps.fill_row((self.y0 + row, self.x0), self.mm[offset:offset+self.width], self.pending)
+        for key in self.tried:
+            chunk = self.chunks.get(key)
+            bitmaps.fill_chunk(key, None if chunk is None else chunk.flags)
+    def translate(self, table):
+        grid.ChunkedGrid.translate(self, table)
+        self.pending = self.pending.translate(table)
+    def positions(self):
+        self.load_all()
+        return grid.ChunkedGrid.positions(self)
+    def bounds(self):
+        return self.y0, self.x0, self.y0 + self.height - 1, self.x0 + self.width - 1
+
+def open_map(file, saved=SAVED_FLAGS):
+    return MappedGrid(file, saved)
+
+if __name__ == "__main__":
+    files = sys.argv[1:] or [os.path.join(state.realpath("maps"), file) for file in sorted(os.listdir(state.realpath("maps"))) if file.endswith(".mp")]
+    for file in files:
+        compile_map(file)
+        print("%s -> %s" % (file, compiled_name(file)))
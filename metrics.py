@@ -0,0 +1,94 @@
+### Metrics module
+# Timers and counters of what the game spends its time on.
+# Each sample of a timer (in milliseconds) goes into a ring buffer keeping
+# the last SAMPLES ones, from which the percentiles are computed; counters
+# only count. See game.MetricsWindow for the overlay.
+
+import array, functools, json, time
+
+SAMPLES = 256
+# nothing is measured when False
+enabled = True
+
+class Ring:
+    # the last `size' samples
+    def __init__(self, size=SAMPLES):
+        self.samples = array.array("d", bytes(8*size))
+        self.size = size
+        # number of samples ever added
+        self.count = 0
+    def add(self, value):
+        self.samples[self.count % self.size] = value
+        self.count += 1
+    def values(self):
+        return self.samples[:min(self.count, self.size)]
+    def percentile(self, p):
+        # nearest rank percentile of the samples kept, 0 without sample
+        values = sorted(self.values())
+        if not values:
+            return 0
+        return values[min(len(values)-1, max(0, -(-p*len(values) // 100) - 1))]
+    def summary(self):
+        values = self.values()
+        return {
+            "count": self.count,
+            "last": self.samples[(self.count-1) % self.size] if self.count else 0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": max(values) if values else 0
+        }
+
+# name -> Ring
+timers = {}
+# name -> int
+counters = {}
+
+def sample(name, value):
+    if not enabled:
+        return
+    if name not in timers:
+        timers[name] = Ring()
+    timers[name].add(value)
+
+def count(name, value=1):
+    if not enabled:
+        return
+    counters[name] = counters.get(name, 0) + value
+
+def timed(name):
+    # decorator timing every call of a function
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                sample(name, (time.perf_counter() - start)*1000)
+        return wrapper
+    return decorator
+
+def clear():
+    timers.clear()
+    counters.clear()
+
+def report():
+    return {
+        "timers": {name: ring.summary() for name, ring in sorted(timers.items())},
+        "counters": dict(sorted(counters.items()))
+    }
+
+def lines():
+    # the report as text, one metric per line
+    result = ["%-20s %8s %8s %8s %7s" % ("ms", "p50", "p95", "max", "count")]
+    for name, summary in report()["timers"].items():
+        result.append("%-20s %8.3f %8.3f %8.3f %7d" % (name[:20], summary["p50"], summary["p95"], summary["max"], summary["count"]))
+    for name, value in report()["counters"].items():
+        result.append("%-20s %35d" % (name[:20], value))
+    return result
+
+def export(file):
+    with open(file, "w") as f:
+        json.dump(report(), f, indent=4)
@@ -0,0 +1,203 @@
+### Pursuit module
+# Incremental path planning for a creature chasing a moving target
+# (D* Lite / LPA*): the search is rooted at an anchor, where the pursuer was
+# when it was last planned, and its state is kept between the turns, so that
+# when the target moves or a cell changes (a door opening...) only the part
+# of the search made wrong by the change is done again.
+# The pursuer walking along its path stays on a shortest path from the
+# anchor, the rest of which is a shortest path from it; once it isn't (the
+# target went the other way), the search starts again from it.
+#
+# g is the distance from the anchor as last computed, rhs the one computed
+# from the g of the neighbours; a cell is consistent when both are equal.
+# The cells to compute again are kept in a heap by key (g or rhs, the lower,
+# plus the heuristic to the target, plus km which grows as the target moves
+# so that the keys already in the heap stay lower bounds).
+# Nodes are indexes of the bitmaps of the map (see grid.Bitmaps), whose
+# border isn't walkable.
+
+import heapq
+
+INFINITY = float("inf")
+# expansions per call of next_step; the search goes on at the next call
+MAX_EXPANSIONS = 20000
+
+class Planner:
+    def __init__(self, max_expansions=MAX_EXPANSIONS):
+        self.max_expansions = max_expansions
+        self.bitmaps = None
+        self.revision = None
+        self.anchor = None
+        self.target = None
+        # number of full searches and of expansions, see bench.py pursuit
+        self.searches = 0
+        self.expansions = 0
+    def reset(self, bitmaps, anchor, target):
+        self.bitmaps = bitmaps
+        self.width = bitmaps.width
+        self.steps = (-self.width, 1, self.width, -1)
+        self.anchor = anchor
+        self.target = target
+        self.ty, self.tx = divmod(target, self.width)
+        self.km = 0
+        self.g = {}
+        self.rhs = {anchor: 0}
+        # index -> key of the cell in the heap, older entries being skipped
+        self.queued = {}
+        self.heap = []
+        # cells of the path from the anchor to the target as last found, their
+        # index in it, and the cells whose g changed since
+        self.path = []
+        self.position = {}
+        self.touched = set()
+        self.push(anchor)
+        self.searches += 1
+    def heuristic(self, index):
+        y, x = divmod(index, self.width)
+        return abs(y-self.ty) + abs(x-self.tx)
+    def key(self, index):
+        value = min(self.g.get(index, INFINITY), self.rhs.get(index, INFINITY))
+        y, x = divmod(index, self.width)
+        return value + abs(y-self.ty) + abs(x-self.tx) + self.km, value
+    def push(self, index):
+        key = self.key(index)
+        self.queued[index] = key
+        heapq.heappush(self.heap, (key, index))
+    def update(self, index):
+        # rhs of the cell computed again, and queued if inconsistent
+        if index != self.anchor:
+            if self.bitmaps.walkable[index]:
+                g = self.g
+                self.rhs[index] = min(g.get(index+step, INFINITY) for step in self.steps) + 1
+            else:
+                self.rhs[index] = INFINITY
+        self.queued.pop(index, None)
+        if self.g.get(index, INFINITY) != self.rhs.get(index, INFINITY):
+            self.push(index)
+    def changed(self, pos):
+        # the cell at pos became walkable or not
+        index = self.bitmaps.index(pos)
+        self.update(index)
+        for step in self.steps:
+            self.update(index + step)
+    def move_target(self, target):
+        if target != self.target:
+            self.km += self.heuristic(target)
+            self.target = target
+            self.ty, self.tx = divmod(target, self.width)
+    def search(self):
+        # computes g again until the one of the target is right; False when
+        # out of expansions
+        g = self.g
+        rhs = self.rhs
+        heap = self.heap
+        queued = self.queued
+        touched = self.touched
+        walkable = self.bitmaps.walkable
+        target = self.target
+        for i in range(self.max_expansions):
+            while heap and queued.get(heap[0][1]) != heap[0][0]:
+                heapq.heappop(heap)
+            if not heap:
+                return True
+            key, index = heap[0]
+            if key >= self.key(target) and rhs.get(target, INFINITY) == g.get(target, INFINITY):
+                return True
+            heapq.heappop(heap)
+            del queued[index]
+            self.expansions += 1
+            new_key = self.key(index)
+            if key < new_key:
+                # the target moved since it was queued
+                queued[index] = new_key
+                heapq.heappush(heap, (new_key, index))
+            elif g.get(index, INFINITY) > rhs[index]:
+                g[index] = cost = rhs[index]
+                touched.add(index)
+                cost += 1
+                for step in self.steps:
+                    next = index + step
+                    if walkable[next] and next != self.anchor and cost < rhs.get(next, INFINITY):
+                        rhs[next] = cost
+                        self.queued.pop(next, None)
+                        if g.get(next, INFINITY) != cost:
+                            self.push(next)
+            else:
+                g[index] = INFINITY
+                touched.add(index)
+                self.update(index)
+                for step in self.steps:
+                    self.update(index + step)
+        return False
+    def backtrack(self, start):
+        # the cell after start on the path from the anchor to the target,
+        # None if start isn't on it; the path is followed back from the
+        # target up to the part of the last one whose cells kept their g
+        g = self.g
+        path = self.path
+        position = self.position
+        valid = min((position[index] for index in self.touched if index in position), default=len(path))
+        self.touched = set()
+        current = self.target
+        distance = g.get(current, INFINITY)
+        if distance == INFINITY:
+            return None
+        sy, sx = divmod(start, self.width)
+        steps = self.steps
+        tail = []
+        while position.get(current, valid) >= valid or position[current] != distance:
+            tail.append(current)
+            if distance == 0:
+                # the anchor, nothing of the last path was kept
+                distance = -1
+                break
+            distance -= 1
+            lower = [current + step for step in steps if g.get(current + step) == distance]
+            if not lower:
+                path.clear()
+                position.clear()
+                return None
+            if len(lower) > 1:
+                # the nearest to start, so that the path found goes through
+                # it whenever it can
+                lower.sort(key=lambda index: abs(index // self.width - sy) + abs(index % self.width - sx))
+            current = lower[0]
+        for index in path[distance+1:]:
+            del position[index]
+        del path[distance+1:]
+        for index in reversed(tail):
+            position[index] = len(path)
+            path.append(index)
+        if position.get(start, len(path)) >= len(path)-1:
+            return None
+        return path[position[start]+1]
+    def next_step(self, pos, target, map):
+        # the cell to go to from pos to reach target on the map, None if
+        # there is no path (or none found yet)
+        bitmaps = map.bitmaps()
+        start = bitmaps.index(pos)
+        goal = bitmaps.index(target)
+        if not bitmaps.inside(pos) or goal == None or not bitmaps.walkable[goal]:
+            return None
+        if bitmaps is not self.bitmaps:
+            self.reset(bitmaps, start, goal)
+        elif self.revision != map.revision:
+            cells = map.grid.changes_since(self.revision)
+            if cells == None:
+                self.reset(bitmaps, start, goal)
+            else:
+                for cell in cells:
+                    self.changed(cell)
+        self.revision = map.revision
+        self.move_target(goal)
+        if not self.search():
+            return None
+        next = self.backtrack(start)
+        if next == None and start != goal and start != self.anchor:
+            # off the path found from the anchor, or cut from it: planned
+            # again from pos
+            self.reset(bitmaps, start, goal)
+            if not self.search():
+                return None
+            next = self.backtrack(start)
+        return None if next == None else bitmaps.pos(next)
@@ -0,0 +1,141 @@
+### Save file module
+# Columnar encoding of the entities of a map (Creature.save() dicts).
+# Entities are written in blocks of BLOCK_SIZE, one JSON line each:
+#   {"count": n, "columns": {attribute: [rows, values]}, "items": {id: item}}
+# rows being null when every entity of the block has the attribute (the
+# attributes left to their default are already left out by save()), and the
+# indexes in the block of the entities having it otherwise.
+# The items of the inventories are replaced by the id of their template,
+# a template being written once, in the first block using it.
+#
+# The entity section of a map starts with a header line:
+#   {"columns": VERSION, "creatures": count, "items": count, "tiles": [...]}
+# followed by the blocks of the creatures, then the ones of the items.
+
+import json, marshal
+
+VERSION = 1
+BLOCK_SIZE = 1024
+
+class SaveFileError(Exception):
+    pass
+
+class Encoder:
+    def __init__(self):
+        # repr of an item template -> id
+        self.templates = {}
+        # repr of an inventory -> the inventory with ids, most inventories
+        # being alike
+        self.inventories = {}
+    def item(self, item, new):
+        key = repr(item)
+        if key not in self.templates:
+            self.templates[key] = len(self.templates)
+            new[self.templates[key]] = item
+        return self.templates[key]
+    def inventory(self, inventory, new):
+        key = repr(inventory)
+        if key not in self.inventories:
+            self.inventories[key] = {
+                "slots": {slot: self.item(item, new) for slot, item in inventory["slots"].items()},
+                "inventory": [self.item(item, new) for item in inventory["inventory"]]
+            }
+        return self.inventories[key]
+    def block(self, entities):
+        # JSON line of a block
+        columns = {}
+        new = {}
+        for row, entity in enumerate(entities):
+            for key, value in entity.items():
+                if key == "inventory":
+                    value = self.inventory(value, new)
+                if key not in columns:
+                    columns[key] = ([], [])
+                rows, values = columns[key]
+                rows.append(row)
+                values.append(value)
+        count = len(entities)
+        return json.dumps({
+            "count": count,
+            "columns": {key: [None if len(rows) == count else rows, values] for key, (rows, values) in columns.items()},
+            "items": new
+        })
+    def encode(self, entities):
+        # JSON lines of the blocks of `entities' (any iterable)
+        block = []
+        for entity in entities:
+            block.append(entity)
+            if len(block) == BLOCK_SIZE:
+                yield self.block(block)
+                block = []
+        if block:
+            yield self.block(block)
+
+class Decoder:
+    def __init__(self):
+        # id -> item template, marshalled: every entity gets its own copy
+        self.templates = {}
+    def inventory(self, inventory):
+        return {
+            "slots": {slot: marshal.loads(self.templates[id]) for slot, id in inventory["slots"].items()},
+            "inventory": [marshal.loads(self.templates[id]) for id in inventory["inventory"]]
+        }
+    def block(self, line):
+        # entities of a block
+        block = json.loads(line)
+        for id, item in block["items"].items():
+            self.templates[int(id)] = marshal.dumps(item)
+        entities = [{} for i in range(block["count"])]
+        for key, (rows, values) in block["columns"].items():
+            if key == "inventory":
+                values = [self.inventory(value) for value in values]
+            for row, value in zip(range(block["count"]) if rows is None else rows, values):
+                entities[row][key] = value
+        return entities
+    def decode(self, readline, count):
+        # the `count' entities of the blocks read with readline
+        while count > 0:
+            line = readline()
+            if not line:
+                raise SaveFileError("%s entities missing" % count)
+            entities = self.block(line)
+            count -= len(entities)
+            yield from entities
+
+def write_objs(write, creatures, items, tiles=(), counts=None):
+    # writes an entity section; creatures and items may be any iterable,
+    # their lengths being given as counts if they have none
+    if counts == None:
+        counts = len(creatures), len(items)
+    write(json.dumps({"columns": VERSION, "creatures": counts[0], "items": counts[1], "tiles": list(tiles)}) + "\n")
+    encoder = Encoder()
+    for entities in (creatures, items):
+        for line in encoder.encode(entities):
+            write(line + "\n")
+
+def stream_objs(readline):
+    # reads an entity section lazily: returns (tiles, entities), entities
+    # yielding ("creatures", entity) then ("items", entity) pairs, a block
+    # being read only once the entities of the previous one are used; an
+    # old style section (a single JSON object of lists) is read at once
+    header = json.loads(readline())
+    if "columns" not in header:
+        entities = [(kind, entity) for kind in ("creatures", "items") for entity in header.get(kind, [])]
+        return header.get("tiles", []), iter(entities)
+    if header["columns"] != VERSION:
+        raise SaveFileError("unknown entity section version %s" % header["columns"])
+    def entities():
+        decoder = Decoder()
+        for kind in ("creatures", "items"):
+            for entity in decoder.decode(readline, header[kind]):
+                yield kind, entity
+    return header["tiles"], entities()
+
+def read_objs(readline):
+    # reads a whole entity section as {"creatures": [...], "items": [...],
+    # "tiles": [...]}, see stream_objs
+    tiles, entities = stream_objs(readline)
+    objs = {"creatures": [], "items": [], "tiles": tiles}
+    for kind, entity in entities:
+        objs[kind].append(entity)
+    return objs
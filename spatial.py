@@ -0,0 +1,97 @@
+### Spatial module
+# Index of the positions of entities, so that proximity queries don't scan
+# every entity: entities are kept in buckets of BUCKET_SIZE*BUCKET_SIZE
+# cells, and a query only looks at the buckets it overlaps
+
+import heapq
+
+BUCKET_SHIFT = 3
+BUCKET_SIZE = 1 << BUCKET_SHIFT
+
+def bucket_key(pos):
+    return pos[0] >> BUCKET_SHIFT, pos[1] >> BUCKET_SHIFT
+
+def square_distance(pos1, pos2):
+    return (pos1[0]-pos2[0])**2 + (pos1[1]-pos2[1])**2
+
+class SpatialIndex:
+    def __init__(self):
+        # bucket key -> {uuid}
+        self.buckets = {}
+        # uuid -> pos
+        self.positions = {}
+    def __len__(self):
+        return len(self.positions)
+    def __contains__(self, uuid):
+        return uuid in self.positions
+    def clear(self):
+        self.buckets.clear()
+        self.positions.clear()
+    def add(self, uuid, pos):
+        if uuid in self.positions:
+            self.remove(uuid)
+        self.positions[uuid] = pos
+        key = bucket_key(pos)
+        if key in self.buckets:
+            self.buckets[key].add(uuid)
+        else:
+            self.buckets[key] = {uuid}
+    def remove(self, uuid):
+        key = bucket_key(self.positions.pop(uuid))
+        self.buckets[key].discard(uuid)
+        if not self.buckets[key]:
+            del self.buckets[key]
+    def move(self, uuid, pos):
+        if bucket_key(self.positions[uuid]) == bucket_key(pos):
+            self.positions[uuid] = pos
+        else:
+            self.add(uuid, pos)
+    def rect(self, y0, x0, y1, x1):
+        # uuids in the rectangle (y0, x0)-(y1, x1), bounds included
+        for by in range(y0 >> BUCKET_SHIFT, (y1 >> BUCKET_SHIFT) + 1):
+            for bx in range(x0 >> BUCKET_SHIFT, (x1 >> BUCKET_SHIFT) + 1):
+                for uuid in self.buckets.get((by, bx), ()):
+                    y, x = self.positions[uuid]
+                    if y0 <= y <= y1 and x0 <= x <= x1:
+                        yield uuid
+    def radius(self, pos, radius):
+        # uuids at an euclidian distance of at most `radius' from pos
+        r = int(radius)
+        square = radius*radius
+        for uuid in self.rect(pos[0]-r, pos[1]-r, pos[0]+r, pos[1]+r):
+            if square_distance(self.positions[uuid], pos) <= square:
+                yield uuid
+    def nearest(self, pos, k=1, exclude=()):
+        # the k nearest uuids, nearest first
+        total = len(self.positions) - sum(1 for uuid in exclude if uuid in self.positions)
+        center = bucket_key(pos)
+        found = []
+        ring = 0
+        while len(found) < total:
+            if 8*ring > len(self.buckets):
+                # sparse index, far from the query: every entity is looked at
+                found = [(square_distance(p, pos), uuid) for uuid, p in self.positions.items() if uuid not in exclude]
+                break
+            for key in self.ring(center, ring):
+                for uuid in self.buckets.get(key, ()):
+                    if uuid not in exclude:
+                        found.append((square_distance(self.positions[uuid], pos), uuid))
+            # the buckets out of the ring are at least this far
+            reach = ring*BUCKET_SIZE + 1
+            if len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= reach*reach:
+                break
+            ring += 1
+        return [uuid for distance, uuid in heapq.nsmallest(k, found)]
+    @staticmethod
+    def ring(center, ring):
+        # bucket keys at a chebyshev distance of `ring' from center
+        cy, cx = center
+        if ring == 0:
+            yield center
+            return
+        for x in range(cx-ring, cx+ring+1):
+            yield cy-ring, x
+            yield cy+ring, x
+        for y in range(cy-ring+1, cy+ring):
+            yield y, cx-ring
+            yield y, cx+ring
@@ -2,7 +2,7 @@
 # Contains every public shared objects,
 # so at any moment this represents the "state" of the program
 
-import curses, math, os
+import curses, curses.ascii, math, os, sys, importlib, metrics
 from verticalhandler import KeyHandler, QuitGame
 
 ### DEFINES ###
@@ -78,8 +78,14 @@ def message(*args, source="game"):
     warning("deprecated usage of 'message'")
     output("["+source+"]",*args)
 
+# Set by main, messages go to stderr until then (e.g. in command line tools)
+message_window = None
+
 def output(*args, sep=' '):
-    message_window.update_messages(sep.join(str(e) for e in args))
+    if message_window is None:
+        print(sep.join(str(e) for e in args), file=sys.stderr)
+    else:
+        message_window.update_messages(sep.join(str(e) for e in args))
 
 def quit():
     raise QuitGame()
@@ -87,6 +93,7 @@ def quit():
 # load functions
 
 def load():
+    import icon, items
     icon.load_icons()
     items.load_items()
 ### FRAMES ###
@@ -116,6 +123,7 @@ class Screen:
         self.windows.append(window)
     def remove_window(self, window):
         self.windows.remove(window)
+    @metrics.timed("refresh")
     def refresh(self):
         self.clear()
         for window in self.windows:
@@ -274,11 +282,30 @@ class Turns:
         self.parent.addstr(self.y, self.x, "Turns: %s (%s)" % (game_frame.player_turns, game_frame.turns))
 
 
-import action, verticalhandler, game, creature, items, color, map, icon
+# The other modules (and their main classes) are imported on first use,
+# so that importing state doesn't load the whole game
+LAZY_MODULES = {"action", "verticalhandler", "game", "creature", "items", "color", "map", "icon", "levels", "spatial", "components", "fov", "flow", "pursuit"}
+LAZY_NAMES = {
+    "Item": "items",
+    "InventoryWindow": "items",
+    "Inventory": "items",
+    "ActionFrame": "action",
+    "ActionWindow": "action",
+    "Action": "action",
+    "GameFrame": "game",
+    "GameWindow": "game",
+    "Creature": "creature",
+    "Hero": "creature",
+    "colors": "color",
+    "Map": "map"
+}
 
-from items import Item, InventoryWindow, Inventory
-from action import ActionFrame, ActionWindow, Action
-from game import GameFrame, GameWindow
-from creature import Creature, Hero
-from color import colors
-from map import Map
+def __getattr__(name):
+    if name in LAZY_MODULES:
+        value = importlib.import_module(name)
+    elif name in LAZY_NAMES:
+        value = getattr(importlib.import_module(LAZY_NAMES[name]), name)
+    else:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    globals()[name] = value
+    return value